@@ -0,0 +1,103 @@
+"""
+Memory footprint of the trees built by ``velin.parsedoc``.
+
+Parse the multi-line docstrings of the Python files under a directory (the
+standard library by default), keep all the trees alive, and print the memory
+they use per tree, as traced by ``tracemalloc``. With ``--compare REV``, the
+velin of the git revision ``REV`` is measured first on the same docstrings.
+
+    python benchmarks/memory.py [--compare REV] [path]
+"""
+
+import argparse
+import ast
+import gc
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import tracemalloc
+import warnings
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import velin
+from velin import parsedoc
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def docstrings(root):
+    # not velin.walk, which older revisions don't have.
+    for path in sorted(Path(root).rglob("*.py")):
+        try:
+            tree = ast.parse(path.read_bytes())
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                doc = ast.get_docstring(node, clean=False)
+                if doc and len(doc.splitlines()) > 1:
+                    yield doc
+
+
+def measure(root):
+    docs = list(docstrings(root))
+    trees = []
+    with warnings.catch_warnings(), redirect_stdout(io.StringIO()):
+        warnings.simplefilter("ignore")
+        gc.collect()
+        tracemalloc.start()
+        for doc in docs:
+            res = parsedoc(doc)
+            if res:
+                trees.append(res[0])
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    # only what velin allocated, leaving out modules imported on the way.
+    snapshot = snapshot.filter_traces(
+        [tracemalloc.Filter(True, os.path.join(os.path.dirname(velin.__file__), "*"))]
+    )
+    size = sum(stat.size for stat in snapshot.statistics("filename"))
+    chars = sum(len(doc) for doc in docs)
+    print(f"{len(trees)} trees out of {len(docs)} docstrings ({chars} characters)")
+    if not trees:
+        print("no docstring parsed, is numpydoc installed?")
+        return False
+    print(f"retained: {size / 1024:.0f} KiB, {size / len(trees):.0f} B per tree")
+    return True
+
+
+def measure_revision(rev, root):
+    archive = subprocess.run(
+        ["git", "archive", rev, "velin"], cwd=REPO, capture_output=True, check=True
+    ).stdout
+    with tempfile.TemporaryDirectory() as d:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(d)
+        env = {**os.environ, "PYTHONPATH": d}
+        res = subprocess.run([sys.executable, __file__, root], env=env)
+    return res.returncode == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", nargs="?", default=os.path.dirname(os.__file__))
+    parser.add_argument(
+        "--compare", metavar="REV", help="measure the velin of a git revision first"
+    )
+    args = parser.parse_args(argv)
+    ok = True
+    if args.compare:
+        print(f"{args.compare}:")
+        ok = measure_revision(args.compare, args.path)
+        print("working tree:")
+    ok = measure(args.path) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
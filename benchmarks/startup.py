@@ -0,0 +1,59 @@
+"""
+Startup time of the ``velin`` command.
+
+Run ``velin --check`` on a clean file a number of times, and print the best
+wall time as well as the slowest imports. tests/test_startup.py guards the
+modules that must not be imported on this path.
+
+    python benchmarks/startup.py [n]
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CLEAN = '''
+def f(a):
+    """
+    Summary.
+
+    Parameters
+    ----------
+    a : int
+        a number
+    """
+'''
+
+
+def main(n=10):
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "clean.py"
+        path.write_text(CLEAN)
+        cmd = [sys.executable, "-m", "velin", "--check", "--no-cache", str(path)]
+        times = []
+        for _ in range(n):
+            start = time.perf_counter()
+            subprocess.run(cmd, check=True, capture_output=True)
+            times.append(time.perf_counter() - start)
+        print(f"velin --check, best of {n}: {min(times) * 1000:.1f} ms")
+
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", *cmd[1:]],
+            capture_output=True,
+            text=True,
+        )
+    imports = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        imports.append((int(cumulative), name.strip()))
+    print("slowest imports, cumulative (ms):")
+    for cumulative, name in sorted(imports, reverse=True)[:10]:
+        print(f"  {cumulative / 1000:8.1f} {name}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
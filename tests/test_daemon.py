@@ -0,0 +1,136 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import velin
+from velin import daemon as velin_daemon
+from velin.daemon import run_client
+
+# the subprocesses run in temporary directories, make sure they find velin.
+ROOT = os.path.dirname(os.path.dirname(velin.__file__))
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, "fork"), reason="the daemon needs fork and unix sockets"
+)
+
+SOURCE = '''
+def f(a, b):
+    """
+    Summary.
+
+    Parameters
+    ----------
+    a : int
+        a number
+    c : int
+        another number
+    """
+'''
+
+
+@pytest.fixture(autouse=True)
+def pythonpath(monkeypatch):
+    path = os.environ.get("PYTHONPATH")
+    monkeypatch.setenv("PYTHONPATH", ROOT + (os.pathsep + path if path else ""))
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    sock = tmp_path / "velin.sock"
+    monkeypatch.setenv("VELIN_DAEMON_SOCKET", str(sock))
+    monkeypatch.setenv("VELIN_CACHE_DIR", str(tmp_path / "cache"))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "velin", "daemon", "--idle-timeout", "60"],
+        stderr=subprocess.PIPE,
+    )
+    for _ in range(100):
+        if sock.exists():
+            break
+        time.sleep(0.1)
+    else:
+        proc.kill()
+        pytest.fail(proc.communicate()[1].decode())
+    yield sock
+    proc.terminate()
+    proc.wait()
+
+
+def velin(cwd, *args):
+    return subprocess.run(
+        [sys.executable, "-m", "velin", "--no-color", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_daemon_same_output(tmp_path, daemon):
+    (tmp_path / "a.py").write_text(SOURCE)
+    local = velin(tmp_path, "--check", "a.py")
+    remote = velin(tmp_path, "--check", "a.py", "--use-daemon")
+    assert local.returncode == remote.returncode == 1
+    assert "+    b : int" in local.stdout
+    assert (local.stdout, local.stderr) == (remote.stdout, remote.stderr)
+
+    remote = velin(tmp_path, "--write", "a.py", "--use-daemon")
+    assert remote.returncode == 0
+    assert "b : int" in (tmp_path / "a.py").read_text()
+    assert "c : int" not in (tmp_path / "a.py").read_text()
+
+
+def test_no_daemon_runs_locally(tmp_path, monkeypatch):
+    monkeypatch.setenv("VELIN_DAEMON_SOCKET", str(tmp_path / "missing.sock"))
+    assert run_client(["--check", "a.py"]) is None
+    (tmp_path / "a.py").write_text(SOURCE)
+    res = velin(tmp_path, "--check", "--no-cache", "a.py", "--use-daemon")
+    assert res.returncode == 1
+    assert "+    b : int" in res.stdout
+
+
+def test_other_user_daemon_is_ignored(tmp_path, daemon, monkeypatch, capsys):
+    uid = os.getuid()
+    monkeypatch.setattr(velin_daemon.os, "getuid", lambda: uid + 1)
+    assert run_client(["--check", "a.py"]) is None
+    assert "is not a daemon of yours" in capsys.readouterr().err
+
+
+def test_forwarded_env():
+    env = {"HOME": "/home/me", "GIT_INDEX_FILE": "index", "AWS_SECRET": "x"}
+    assert velin_daemon._forwarded_env(env) == {
+        "HOME": "/home/me",
+        "GIT_INDEX_FILE": "index",
+    }
+
+
+def test_private_socket_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("VELIN_DAEMON_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    path = velin_daemon.socket_path()
+    directory = os.path.dirname(path)
+    assert directory == str(tmp_path / f"velin-{os.getuid()}")
+    velin_daemon._private_dir(directory)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o755)
+    with pytest.raises(SystemExit):
+        velin_daemon._private_dir(directory)
+
+
+def test_children_inherit_loaded_caches(tmp_path, monkeypatch):
+    from velin import cache
+
+    monkeypatch.setattr(cache, "CACHES", {})
+    memo = cache.LRUCache("memo", maxsize=10)
+    memo.put("a", [1])
+    memo.dump(tmp_path)
+
+    memo = cache.LRUCache("memo", maxsize=10)
+    memo.load(tmp_path, eager=True)
+    # the children of the daemon must not read the file again.
+    memo.path(tmp_path).unlink()
+    pid = os.fork()
+    if not pid:
+        os._exit(0 if memo.get("a") == [1] else 1)
+    assert os.waitpid(pid, 0)[1] == 0
@@ -0,0 +1,84 @@
+import difflib
+import re
+
+import pytest
+
+from velin.diff import DiffPrinter, unified_diff
+from velin.ref import Edit, apply_edits
+
+SOURCE = "".join(
+    f'def f{i}(a):\n    """\n    Doc {i}.\n\n    Parameters\n    ----------\n'
+    f'    a : int\n        a number\n    """\n    return a\n\n\n'
+    for i in range(30)
+)
+
+
+def edit(old, new):
+    start = SOURCE.index(old)
+    return Edit(start, start + len(old), new)
+
+
+def _hunk_range(text):
+    start, _, length = text.partition(",")
+    length = int(length or 1)
+    return int(start) - (1 if length else 0), length
+
+
+def patch(lines, diff):
+    """
+    Apply the hunks of ``diff`` to ``lines``, checking their ranges and context.
+    """
+    if not diff:
+        return lines
+    assert diff[:2] == ["--- x.py\n", "+++ x.py\n"]
+    hunks = "".join(line if line[0] == "@" else line + "\n" for line in diff[2:])
+    res, position = [], 0
+    for header, body in re.findall(r"@@ -(\S+ \+\S+) @@\n((?:[ +-].*\n)*)", hunks):
+        (start, old_length), (new_start, new_length) = map(
+            _hunk_range, header.split(" +")
+        )
+        assert start >= position
+        res += lines[position:start]
+        assert new_start == len(res)
+        body = body.splitlines()
+        old = [line[1:] for line in body if line[0] in " -"]
+        new = [line[1:] for line in body if line[0] in " +"]
+        assert (len(old), len(new)) == (old_length, new_length)
+        assert lines[start : start + old_length] == old
+        res += new
+        position = start + old_length
+    return res + lines[position:]
+
+
+@pytest.mark.parametrize(
+    "edits",
+    [
+        [],
+        [edit("Doc 0.", "Doc zero.")],
+        [edit("Doc 3.\n\n", "Doc 3.\n"), edit("Doc 4.", "Doc\n    four.")],
+        [edit("a : int\n", "a: int\n"), edit("Doc 12.", "Doc 12.\n\n    Extended.")],
+        [edit("Doc 29.\n", "Doc 29.\n\n")],
+    ],
+)
+@pytest.mark.parametrize("n", [0, 3, 5])
+def test_unified_diff(edits, n):
+    new = apply_edits(SOURCE, edits)
+    diff = list(unified_diff(SOURCE, edits, "x.py", n))
+    assert patch(SOURCE.splitlines(), diff) == new.splitlines()
+    if len(edits) == 1 and "\n" not in edits[0].text:
+        # a changed line is aligned as when comparing the whole files.
+        expected = difflib.unified_diff(
+            SOURCE.splitlines(), new.splitlines(), n=n, fromfile="x.py", tofile="x.py"
+        )
+        assert diff == list(expected)
+
+
+def test_diff_printer(capsys):
+    lines = ["--- x.py\n", "+++ x.py\n", "@@ -1 +1 @@\n", "-a", "+b"]
+    DiffPrinter(False).print(lines)
+    assert capsys.readouterr().out == "\n".join(lines) + "\n"
+    printer = DiffPrinter(True)
+    printer.print(lines)
+    printer.print(lines)
+    out = capsys.readouterr().out
+    assert "\x1b[" in out and out[: len(out) // 2] == out[len(out) // 2 :]
@@ -1,8 +1,22 @@
 import glob
+import io
 
 import pytest
 
-from velin import compute_indents, reformat
+import velin
+from velin import (
+    _BLANK,
+    _DOCTEST,
+    _HEADER,
+    _PARAGRAPH,
+    _RAW,
+    Doc,
+    Section,
+    _Lines,
+    compute_indents,
+    reformat,
+    reformat_stream,
+)
 
 test_files = glob.glob("examples/*.rst")
 
@@ -18,6 +32,23 @@ def test_reformat_1(test_input, expected):
     assert reformat(inp) == exp.strip("\n")
 
 
+@pytest.mark.parametrize("test_input", test_files)
+def test_reformat_stream(test_input):
+    out = io.StringIO()
+    with open(test_input) as f:
+        reformat_stream(f, out)
+    with open(test_input) as f:
+        assert out.getvalue() == reformat(f.read())
+
+
+def test_reformat_width():
+    assert reformat("aa bb\ncc  dd", width=6) == "aa bb\ncc  dd"
+    assert reformat("aa bb\ncc  dd", width=5) == "aa bb\ncc \ndd"
+    # a long first word leaves an empty line, a trailing one is dropped.
+    assert reformat("x" * 81) == "\n" + "x" * 81
+    assert reformat("x" * 80 + " ") == "x" * 80
+
+
 @pytest.mark.parametrize(
     "test_input,expected",
     [
@@ -53,3 +84,100 @@ example
 )
 def test_blocks(test_input, expected):
     assert compute_indents(test_input.splitlines()) == expected
+
+
+DOC = """Summary.
+
+Parameters
+----------
+x : int
+    The x.
+
+See Also
+--------
+foo : bar
+
+Notes
+-----
+Some notes
+
+>>> a = 1
+
+"""
+
+
+def test_doc_parse():
+    doc, warnings = Doc.parse(DOC.splitlines())
+    assert [type(n).__name__ for n in doc.nodes] == [
+        "Paragraph",
+        "Section",
+        "DeflistParser",
+        "Section",
+        "DeflistParser",
+        "Section",
+        "Paragraph",
+        "CodeBlock",
+        "BlankLine",
+    ]
+    assert doc.nodes[2].entries[0].head == "x"
+    assert list(doc.see_also()) == ["foo"]
+    assert warnings == []
+
+
+def test_doc_line_kinds():
+    lines = _Lines(DOC.splitlines())
+    assert lines.kinds[:6] == [_PARAGRAPH, _BLANK, _HEADER, _PARAGRAPH, _RAW, _RAW]
+    assert lines.kinds[-2:] == [_DOCTEST, _BLANK]
+    # headers take precedence, but could also start a paragraph; "x : int" is
+    # followed by an indented line and cannot.
+    assert lines.paragraphs[2]
+    assert not lines.paragraphs[4]
+
+
+def test_doc_parse_slicing_api():
+    lines = DOC.splitlines()
+    nodes, rest, _ = Section.parse(lines[2:])
+    assert rest == lines[7:]
+    assert [type(n).__name__ for n in nodes] == ["Section", "DeflistParser"]
+
+
+def test_doc_parse_is_linear(monkeypatch):
+    visits = 0
+
+    class Counted(list):
+        def __getitem__(self, key):
+            nonlocal visits
+            item = super().__getitem__(key)
+            visits += len(item) if isinstance(key, slice) else 1
+            return item
+
+    class Lines(Counted, _Lines):
+        def __init__(self, lines):
+            super().__init__(lines)
+            self.kinds = Counted(self.kinds)
+            self.paragraphs = Counted(self.paragraphs)
+
+    monkeypatch.setattr(velin, "_Lines", Lines)
+
+    def parse_visits(n):
+        nonlocal visits
+        visits = 0
+        doc, _ = Doc.parse(DOC.splitlines() * n)
+        assert len(doc.nodes) == 9 * n
+        return visits
+
+    # lines visited, one by one or in slices, grow like the document.
+    small, large = parse_visits(500), parse_visits(2000)
+    assert 3.6 * small < large < 4.4 * small
+
+
+def test_doc_nodes_are_compact():
+    doc, _ = Doc.parse((DOC + "\n" + DOC).splitlines())
+    blanks = [n for n in doc.nodes if type(n).__name__ == "BlankLine"]
+    assert len(blanks) > 1 and all(b is blanks[0] for b in blanks)
+    assert not any(hasattr(n, "__dict__") for n in doc.nodes)
+    titles = [n.header.title.lines[0] for n in doc.nodes if isinstance(n, Section)]
+    assert titles[0] is titles[3] == "Parameters"
+    assert repr(doc.nodes[2]).startswith(
+        "<DeflistParser entries:[<EntryParser head:'x'"
+    )
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from velin import files
+from velin.files import SourceWriter, read_file
+
+
+@pytest.mark.parametrize("mmap_size", [files.MMAP_SIZE, 1])
+def test_read_file(tmp_path, monkeypatch, mmap_size):
+    monkeypatch.setattr(files, "MMAP_SIZE", mmap_size)
+    path = tmp_path / "a.py"
+    data = b"# -*- coding: latin-1 -*-\r\nx = '\xe9'\r\n"
+    path.write_bytes(data)
+    source = read_file(path)
+    assert source[:4] == (
+        "# -*- coding: latin-1 -*-\nx = 'é'\n",
+        "iso-8859-1",
+        "\r\n",
+        len(data),
+    )
+    assert source.mtime_ns == path.stat().st_mtime_ns
+    path.write_bytes(b"\xef\xbb\xbfx = 1\n")
+    assert read_file(path)[:3] == ("x = 1\n", "utf-8-sig", "\n")
+
+
+def test_write_unchanged(tmp_path):
+    path = tmp_path / "a.py"
+    path.write_bytes(b"x = 1\r\n")
+    os.utime(path, (0, 0))
+    with SourceWriter() as writer:
+        assert not writer.write(path, "x = 1\n")
+    assert path.stat().st_mtime == 0
+    assert os.listdir(tmp_path) == ["a.py"]
+
+
+def test_write_preserves_format(tmp_path):
+    path = tmp_path / "a.py"
+    path.write_bytes(b"# coding: latin-1\r\nx = 1\r\n")
+    path.chmod(0o751)
+    (tmp_path / "link.py").symlink_to(path)
+    with SourceWriter(batch=2) as writer:
+        assert writer.write(tmp_path / "link.py", "# coding: latin-1\nx = 'é'\n")
+        # renamed at the end of the batch
+        assert path.read_bytes() == b"# coding: latin-1\r\nx = 1\r\n"
+    assert path.read_bytes() == b"# coding: latin-1\r\nx = '\xe9'\r\n"
+    assert path.stat().st_mode & 0o777 == 0o751
+    assert (tmp_path / "link.py").is_symlink()
+    assert sorted(os.listdir(tmp_path)) == ["a.py", "link.py"]
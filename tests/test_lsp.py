@@ -0,0 +1,170 @@
+import io
+import os
+import subprocess
+import sys
+
+import velin
+from velin.lsp import Server, read_message, write_message
+from velin.ref import STATS, Config
+
+SOURCE = '''def f(a, b):
+    """
+    Summary.
+
+    Parameters
+    ----------
+    a : int
+        a number
+    c : int
+        another number
+    """
+
+
+def g(a):
+    """
+    Summary.
+
+    Parameters
+    ----------
+    a : int
+        a number
+    """
+'''
+
+URI = "file:///tmp/mod.py"
+
+ROOT = os.path.dirname(os.path.dirname(velin.__file__))
+
+
+def make_server():
+    out = io.BytesIO()
+    config = Config(
+        {
+            "with_placeholder": False,
+            "compact_param": False,
+            "space_in_see_also_title": False,
+            "space_in_notes_title": False,
+            "run_fixers": True,
+        }
+    )
+    return Server(out, config), out
+
+
+def messages(out):
+    out.seek(0)
+    res = []
+    while (message := read_message(out)) is not None:
+        res.append(message)
+    out.seek(0)
+    out.truncate()
+    return res
+
+
+def apply(text, edits):
+    lines = text.splitlines(keepends=True)
+    offset = lambda p: sum(map(len, lines[: p["line"]])) + p["character"]  # noqa
+    for edit in sorted(edits, key=lambda e: offset(e["range"]["start"]), reverse=True):
+        r = edit["range"]
+        text = text[: offset(r["start"])] + edit["newText"] + text[offset(r["end"]) :]
+    return text
+
+
+def test_diagnostics_and_formatting():
+    server, out = make_server()
+    server.handle(
+        {
+            "method": "textDocument/didOpen",
+            "params": {"textDocument": {"uri": URI, "text": SOURCE, "version": 1}},
+        }
+    )
+    (notification,) = messages(out)
+    (diagnostic,) = notification["params"]["diagnostics"]
+    assert "renamed 'c' to 'b'" in diagnostic["message"]
+    assert diagnostic["range"]["start"] == {"line": 1, "character": 7}
+
+    server.handle(
+        {
+            "id": 1,
+            "method": "textDocument/formatting",
+            "params": {"textDocument": {"uri": URI}},
+        }
+    )
+    (response,) = messages(out)
+    new = apply(SOURCE, response["result"])
+    assert new == SOURCE.replace("c : int", "b : int")
+
+
+def test_only_changed_docstrings_are_reformatted():
+    server, out = make_server()
+    server.handle(
+        {
+            "method": "textDocument/didOpen",
+            "params": {"textDocument": {"uri": URI, "text": SOURCE, "version": 1}},
+        }
+    )
+    messages(out)
+    misses = STATS["docstrings_misses"]
+    # rename c to b in the first docstring, g is unchanged.
+    server.handle(
+        {
+            "method": "textDocument/didChange",
+            "params": {
+                "textDocument": {"uri": URI, "version": 2},
+                "contentChanges": [
+                    {
+                        "range": {
+                            "start": {"line": 8, "character": 4},
+                            "end": {"line": 8, "character": 5},
+                        },
+                        "text": "b",
+                    }
+                ],
+            },
+        }
+    )
+    (notification,) = messages(out)
+    assert notification["params"]["diagnostics"] == []
+    assert server.documents[URI].text == SOURCE.replace("c : int", "b : int")
+    assert STATS["docstrings_misses"] == misses + 1
+
+
+def test_stdio_session(tmp_path):
+    input = io.BytesIO()
+    for message in [
+        {"id": 1, "method": "initialize", "params": {}},
+        {"method": "initialized", "params": {}},
+        {
+            "method": "textDocument/didOpen",
+            "params": {"textDocument": {"uri": URI, "text": SOURCE, "version": 1}},
+        },
+        {"id": 2, "method": "shutdown"},
+        {"method": "exit"},
+    ]:
+        write_message(input, {"jsonrpc": "2.0", **message})
+    res = subprocess.run(
+        [sys.executable, "-m", "velin", "lsp"],
+        input=input.getvalue(),
+        capture_output=True,
+        env={"VELIN_CACHE_DIR": str(tmp_path), "PYTHONPATH": ROOT},
+    )
+    assert res.returncode == 0, res.stderr
+    replies = messages(io.BytesIO(res.stdout))
+    assert replies[0]["result"]["capabilities"]["textDocumentSync"]["change"] == 2
+    assert replies[1]["method"] == "textDocument/publishDiagnostics"
+    assert replies[2] == {"jsonrpc": "2.0", "id": 2, "result": None}
+
+
+def test_failing_notification(capsys):
+    server, out = make_server()
+    server.handle(
+        {
+            "method": "textDocument/didChange",
+            "params": {
+                "textDocument": {"uri": "file:///tmp/unknown.py", "version": 2},
+                "contentChanges": [{"text": "x = 1\n"}],
+            },
+        }
+    )
+    assert "error handling textDocument/didChange" in capsys.readouterr().err
+    server.handle({"id": 1, "method": "shutdown"})
+    assert messages(out) == [{"jsonrpc": "2.0", "id": 1, "result": None}]
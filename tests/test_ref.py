@@ -0,0 +1,508 @@
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from numpydoc.docscrape import Parameter
+
+from velin.cache import STATS
+from velin.examples_section_utils import (
+    BLACK_CACHE,
+    _black_key,
+    _reformat_batch,
+    reformat,
+    reformat_batch,
+    reformat_example_lines,
+)
+from velin.git import staged_line_ranges, toplevel
+from velin.ref import (
+    DOC_MEMO,
+    Config,
+    SectionFormatter,
+    SkipPattern,
+    SkipPatterns,
+    _check_reparse,
+    _collect_docstrings,
+    _iter_docstrings,
+    _may_have_docstrings,
+    _reformat_docstring,
+    _reformat_file,
+    apply_edits,
+    compute_new_doc,
+    docstring_edits,
+    main,
+)
+
+SOURCE = '''
+def f(a, b):
+    """
+    Parameters
+    ----------
+    a: int
+        its a
+    b : int
+        its b
+    """
+
+
+def g(a):
+    """
+    Parameters
+    ----------
+    a : int
+        its a
+    """
+'''
+
+
+def run_main(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, "argv", ["velin", "--no-color", *map(str, args)])
+    with pytest.raises(SystemExit) as e:
+        main()
+    return capsys.readouterr().out, e.value.code
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("VELIN_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for i in range(4):
+        (tmp_path / f"mod{i}.py").write_text(SOURCE)
+    (tmp_path / "clean.py").write_text("def h():\n    pass\n")
+    return tmp_path
+
+
+def test_jobs_same_output(tree, monkeypatch, capsys):
+    serial = run_main(monkeypatch, capsys, "--check", tree)
+    parallel = run_main(monkeypatch, capsys, "--check", "-j", "2", tree)
+    assert serial == parallel
+    assert serial[1] != 0
+    assert serial[0].count("+++") == 4
+
+
+def test_split_docstrings_same_output():
+    data = SOURCE * 5
+    config = Config({})
+    serial = _reformat_file(data, "x.py", False, False, config=config, obj_p=[])
+    with ProcessPoolExecutor(2) as executor:
+        split = _reformat_file(
+            data,
+            "x.py",
+            False,
+            False,
+            config=config,
+            obj_p=[],
+            executor=executor,
+            n_chunks=3,
+        )
+    assert split == serial
+    assert serial[0] != data
+
+
+def test_cache_skips_clean_files(tree, cache_dir, monkeypatch, capsys):
+    first = run_main(monkeypatch, capsys, "--check", tree)
+    assert len(list(cache_dir.glob("cache.*.json"))) == 1
+    second = run_main(monkeypatch, capsys, "--check", tree)
+    assert first == second
+    uncached = run_main(monkeypatch, capsys, "--check", "--no-cache", tree)
+    assert first == uncached
+
+
+def test_cache_skips_unmodified_files(tree, monkeypatch, capsys):
+    from velin import ref
+
+    clean = tree / "clean.py"
+    os.utime(clean, (0, 0))
+    run_main(monkeypatch, capsys, "--check", tree)
+    read, reformatted = [], []
+    read_file, file_edits = ref.read_file, ref._file_edits
+    monkeypatch.setattr(ref, "read_file", lambda p: read.append(p) or read_file(p))
+    monkeypatch.setattr(
+        ref,
+        "_file_edits",
+        lambda d, f, *a, **k: reformatted.append(f) or file_edits(d, f, *a, **k),
+    )
+    run_main(monkeypatch, capsys, "--check", tree)
+    assert clean not in read
+    assert len(reformatted) == 4
+    # touched, but with the same content: read but not reformatted.
+    os.utime(clean, (1, 1))
+    run_main(monkeypatch, capsys, "--check", tree)
+    assert clean in read
+    assert clean not in reformatted
+
+
+def test_docstring_memo():
+    DOC_MEMO.data.clear()
+    config = Config({})
+    hits = STATS["docstrings_hits"]
+    first = _reformat_file(SOURCE, "x.py", False, False, config=config, obj_p=[])
+    assert STATS["docstrings_hits"] == hits
+    second = _reformat_file(SOURCE * 3, "x.py", False, False, config=config, obj_p=[])
+    assert STATS["docstrings_hits"] == hits + 6
+    assert second[0] == first[0] * 3
+
+
+def test_memo_files(cache_dir, monkeypatch):
+    from velin import cache
+
+    monkeypatch.setattr(cache, "CACHES", {})
+    memo = cache.LRUCache("memo", maxsize=10)
+    memo.put("a", [1])
+    memo.dump()
+    (path,) = cache_dir.glob("memo.*.json")
+    for i in range(cache.MAX_CACHE_FILES):
+        old = cache_dir / f"memo.{i}.json"
+        old.write_text("[]")
+        os.utime(old, (i, i))
+
+    memo = cache.LRUCache("memo", maxsize=10)
+    memo.load()
+    # read on first use only
+    assert not memo._data
+    assert memo.get("a") == [1]
+    mtime = path.stat().st_mtime_ns
+    memo.dump()
+    assert path.stat().st_mtime_ns == mtime
+    memo.put("b", [2])
+    memo.dump()
+    assert len(list(cache_dir.glob("memo.*.json"))) == cache.MAX_CACHE_FILES
+    assert path.exists()
+    assert not (cache_dir / "memo.0.json").exists()
+
+
+def test_black_cache():
+    lines = [">>> x=[1,2]", ">>> f( x )", "3", "", ">>> x=[1,2]", ">>> f( x )"]
+    hits = STATS["examples_hits"]
+    assert reformat_example_lines(lines) == [
+        ">>> x = [1, 2]",
+        "... f(x)",
+        "3",
+        "",
+        ">>> x = [1, 2]",
+        "... f(x)",
+    ]
+    assert STATS["examples_hits"] == hits + 1
+
+
+def test_black_batch():
+    blocks = [
+        "def f( x ):\n    return x",
+        "class A: pass",
+        "import os\nx=os.path.join( 'a','b' )",
+        "x = (",  # invalid, left to reformat to report
+        "for i in range(3):\n    print( i )\n    # comment",
+    ]
+    BLACK_CACHE.data.clear()
+    reformat_batch(blocks)
+    # blocks that don't parse are left to reformat to report.
+    assert [b for b in blocks if _black_key(b) in BLACK_CACHE] == [
+        b for b in blocks if b != "x = ("
+    ]
+    cached = {
+        block: reformat(block.splitlines()) for block in blocks if block != "x = ("
+    }
+    BLACK_CACHE.data.clear()
+    for block, lines in cached.items():
+        assert reformat(block.splitlines()) == lines
+    with pytest.raises(ValueError):
+        reformat(["x = ("])
+
+
+def test_black_batch_unterminated_string():
+    blocks = ['s = """abc', 'def"""', "y=1", "z=2"]
+    BLACK_CACHE.data.clear()
+    reformat_batch(blocks)
+    assert [b for b in blocks if _black_key(b) in BLACK_CACHE] == ["y=1", "z=2"]
+    for block in blocks[:2]:
+        with pytest.raises(ValueError):
+            reformat(block.splitlines())
+    # black accepts the joined blocks, the parts that don't parse are not kept.
+    import black
+
+    BLACK_CACHE.data.clear()
+    _reformat_batch([(_black_key(b), b) for b in blocks], black.FileMode())
+    assert [b for b in blocks if _black_key(b) in BLACK_CACHE] == ["y=1", "z=2"]
+    BLACK_CACHE.data.clear()
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_since(tree, monkeypatch, capsys):
+    git(tree, "init", "-q")
+    git(tree, "add", ".")
+    git(tree, "commit", "-q", "-m", "init")
+    (tree / "mod0.py").write_text(SOURCE + "\n")
+    git(tree, "mv", "mod1.py", "renamed.py")
+    (tree / "mod2.py").unlink()
+    (tree / "new.py").write_text(SOURCE)
+    # excluded as when walking the directory.
+    (tree / "build").mkdir()
+    (tree / "build" / "gen.py").write_text(SOURCE)
+    monkeypatch.chdir(tree)
+    out, code = run_main(monkeypatch, capsys, "--check", "--since", "HEAD", ".")
+    assert code != 0
+    changed = {line[4:] for line in out.splitlines() if line.startswith("+++")}
+    assert changed == {"mod0.py", "renamed.py", "new.py"}
+    # files outside of the path arguments are not considered.
+    (tree / "sub").mkdir()
+    monkeypatch.chdir(tree / "sub")
+    out, code = run_main(monkeypatch, capsys, "--check", "--since", "HEAD", ".")
+    assert (out, code) == ("", 0)
+
+
+def test_line_ranges(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "mod.py"
+    path.write_text(SOURCE + SOURCE.replace("its", "it is"))
+    # only the docstring of the second f, lines 23-31.
+    out, code = run_main(monkeypatch, capsys, "--check", "--line-ranges", "25-25", path)
+    assert code != 0
+    assert out.count("-    a: int") == 1
+    assert "it is a" in out and "its a" not in out
+    out, code = run_main(
+        monkeypatch,
+        capsys,
+        "--check",
+        "--line-ranges",
+        "13-20",
+        "--line-ranges",
+        "35-40",
+        path,
+    )
+    assert (out, code) == ("", 0)
+
+
+def test_staged(tree, monkeypatch, capsys):
+    (tree / "mod0.py").write_text("")
+    git(tree, "init", "-q")
+    git(tree, "add", ".")
+    git(tree, "commit", "-q", "-m", "init")
+    (tree / "mod0.py").write_text(SOURCE)
+    (tree / "mod1.py").write_text(SOURCE.replace("its b", "its b!"))
+    (tree / "mod2.py").write_text(SOURCE.replace("its a", "its a!"))
+    git(tree, "add", "mod0.py", "mod1.py")
+    monkeypatch.chdir(tree)
+    out, code = run_main(monkeypatch, capsys, "--check", "--staged", ".")
+    assert code != 0
+    changed = {line[4:] for line in out.splitlines() if line.startswith("+++")}
+    assert changed == {"mod0.py", "mod1.py"}
+    # the change staged in mod1.py is only in the docstring of f
+    git(tree, "add", "mod1.py")
+    (tree / "mod1.py").write_text(SOURCE.replace("its a\n", "its a!\n"))
+    git(tree, "add", "mod1.py")
+    (tree / "mod0.py").write_text("")
+    git(tree, "add", "mod0.py")
+    out, code = run_main(monkeypatch, capsys, "--check", "--staged", ".")
+    assert "+++ mod1.py" in out
+    assert out.count("@@") == 2
+
+
+def test_staged_names(tmp_path):
+    git(tmp_path, "init", "-q")
+    names = ["a b.py", 'q"uote.py', "é.py", "plain.py"]
+    for name in names:
+        (tmp_path / name).write_text("x = 1\ny = 2\n")
+    git(tmp_path, "add", ".")
+    ranges = staged_line_ranges(tmp_path)
+    assert ranges == {toplevel(tmp_path) / name: [(1, 2)] for name in names}
+
+
+def test_line_ranges_single_file(tree, monkeypatch, capsys):
+    for paths in [[tree], [tree / "mod0.py", tree / "mod1.py"]]:
+        monkeypatch.setattr(
+            sys, "argv", ["velin", "--line-ranges", "1-2", *map(str, paths)]
+        )
+        with pytest.raises(SystemExit) as e:
+            main()
+        assert e.value.code == 2
+        assert "--line-ranges can only be used with a single file" in (
+            capsys.readouterr().err
+        )
+
+
+def test_docstring_edits():
+    data = SOURCE.replace("its b", "its \\\\b") + "\nx = '''\n    a: int\n'''\n"
+    config = Config({})
+    records = _collect_docstrings(data, "x.py", [])
+    results = [
+        _reformat_docstring(r, "x.py", False, False, False, config) for r in records
+    ]
+    edits, fail_check, findings = docstring_edits(data, records, results)
+    assert fail_check
+    (edit,) = edits
+    (finding,) = findings
+    assert finding.qname == "f"
+    assert finding.edit is edit
+    assert finding.issues == (("reformat", "the docstring needs reformatting"),)
+    assert data[edit.start : edit.end] == records[0].docstring.replace("\\", "\\\\")
+    new = apply_edits(data, edits)
+    # only the docstring changed, its escaped backslash is preserved.
+    assert new == data.replace(
+        "    a: int\n        its a", "    a : int\n        its a"
+    )
+    assert "its \\\\b" in new
+
+
+def test_line_ranges_identical_docstrings(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "mod.py"
+    path.write_text(SOURCE * 2)
+    monkeypatch.setattr(
+        sys, "argv", ["velin", "--write", "--line-ranges", "25-25", str(path)]
+    )
+    main()
+    assert path.read_text() == SOURCE + SOURCE.replace("a: int", "a : int")
+
+
+def test_check_reparse(capsys):
+    config = Config({})
+    record = _collect_docstrings(SOURCE.replace("b : int", "c : int"), "x.py", [])[0]
+    new_doc, _, _ = _reformat_docstring(record, "x.py", False, False, False, config)
+    # the docstring is only processed once, so messages are printed once.
+    assert capsys.readouterr().out.count("renamed 'c' to 'b'") == 1
+    _, doc, _, _ = compute_new_doc(
+        record.docstring,
+        "x.py",
+        level=4,
+        compact=False,
+        meta=record.meta,
+        func_name="f",
+        config=config,
+    )
+    _check_reparse(new_doc, doc, "x.py", "f", config)
+    with pytest.raises(ValueError, match="velin --unsafe x.py:f"):
+        _check_reparse(new_doc.replace("its b", "its c"), doc, "x.py", "f", config)
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("x = 1\n", False),
+        ('def f():\n    """One line."""\n    return 1\n', False),
+        (
+            'class A:\n    """\n    A.\n    """\n\n    def f(self):\n        "f."\n',
+            False,
+        ),
+        (SOURCE, True),
+        ('def f(): "One line\\n with an escape."\n', True),
+        ('def f(\n    a,\n):  # comment\n\n    """\n    A.\n    """\n', True),
+        ('async def f():\n    ""\n', True),
+        ('def f():\n    """One""" "concatenated"\n', True),
+    ],
+)
+def test_may_have_docstrings(source, expected):
+    assert _may_have_docstrings(source) is expected
+    if not expected:
+        assert all(
+            len(r.docstring.splitlines()) == 1
+            for r in _collect_docstrings(source, "x.py", [None])
+        )
+
+
+def test_prefilter_skips_parsing(tree, monkeypatch, capsys):
+    skipped = STATS["parse_skipped"]
+    monkeypatch.setattr(sys, "argv", ["velin", "--check", "--stats", str(tree)])
+    with pytest.raises(SystemExit):
+        main()
+    # clean.py has no docstring
+    assert STATS["parse_skipped"] == skipped + 1
+    assert "files skipped without parsing" in capsys.readouterr().err
+
+
+def test_collect_docstrings_statement_bodies(capsys):
+    doc = '"""\n    Doc.\n    """'
+    data = f"""
+async def a():
+    {doc}
+
+try:
+    import x
+except ImportError:
+    class B:
+        def f(self):
+            {doc}
+
+        def g(self):
+            {doc}
+
+if True:
+    def c(x=lambda: 1):
+        {doc}
+        def d():
+            {doc}
+"""
+    records = _iter_docstrings(data, "x.py", ["B.g"])
+    assert next(records).qname == "a"
+    assert [r.qname for r in records] == ["B.f", "c", "c.d"]
+    assert capsys.readouterr().out == "SKIPPING B.g\n"
+
+
+def test_skip_patterns():
+    patterns = SkipPatterns(
+        [SkipPattern(v) for v in ["mod1.py", "mod2.py:f", "(mo)d3.py", "mod2.py:g"]]
+    )
+    assert patterns.excluding("a/mod1.py").value == "mod1.py"
+    assert patterns.excluding("a/mod3.py").value == "(mo)d3.py"
+    assert patterns.excluding("a/mod2.py") is None
+    assert patterns.objects("a/mod2.py") == ["f", "g"]
+    assert patterns.objects("a/mod1.py") == []
+
+
+def test_ignore_patterns(tree, monkeypatch, capsys):
+    (tree / "setup.cfg").write_text(
+        "[velin]\nignore_patterns =\n   mod1.py\n   mod2.py:f\n"
+    )
+    monkeypatch.chdir(tree)
+    out, _ = run_main(monkeypatch, capsys, "--check", "--verbose", ".")
+    assert "ignoring mod1.py (ignore_patterns: mod1.py)" in out
+    assert "SKIPPING f" in out
+    assert "mod2.py" not in out.replace("mod2.py:f", "")
+
+
+def test_section_layout():
+    df = SectionFormatter(conf=Config({"compact_param": False}))
+    ps = [Parameter("a", "int", ["x", "", "y"]), Parameter("b", "", ["z"])]
+    out = []
+    df.write(out, "Parameters", ps, False)
+    # a blank line in a description, entries are separated by blank lines.
+    assert out[2:] == ["a : int", "    x", "", "    y", "", "b", "    z"]
+    out = []
+    df.write(out, "Parameters", ps[1:], False)
+    assert out == ["Parameters", "----------", "b", "    z"]
+    short = ([("f", None)], ["does f"])
+    long = ([("g", "func")], ["x" * 80])
+    out = []
+    df.write(out, "See Also", [short], False)
+    assert out == ["See Also", "--------", "f : does f"]
+    # one description too long: none on the line of its reference
+    out = []
+    df.write(out, "See Also", [short, long], False)
+    assert out == [
+        "See Also",
+        "--------",
+        "f :",
+        "    does f",
+        ":func:`g` :",
+        "    " + "x" * 80,
+    ]
+    out = []
+    df.write(out, "See Also", [short, long], True)
+    assert out[2:] == ["f : does f", ":func:`g` : " + "x" * 80]
+    # the text of a section, as before write.
+    assert df.format_See_Also([short], False) == "See Also\n--------\nf : does f\n"
+    assert SectionFormatter.format_Summary([" "], False) == ""
+    assert (
+        SectionFormatter.format_Returns(ps[1:], False) == "Returns\n-------\nb\n    z\n"
+    )
@@ -0,0 +1,105 @@
+import json
+import sys
+
+import pytest
+
+from velin.ref import main
+
+SOURCE = '''
+def f(a, b):
+    """
+    Parameters
+    ----------
+    a: int
+        its a
+    c : int
+        its b
+    """
+
+
+def g(a, x):
+    """
+    Parameters
+    ----------
+    a : int
+        its a
+    y : int
+        y
+    z : int
+        z
+    """
+'''
+
+
+def run_main(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, "argv", ["velin", "--no-cache", *map(str, args)])
+    with pytest.raises(SystemExit) as e:
+        main()
+    out, err = capsys.readouterr()
+    return out, err, e.value.code
+
+
+def test_jsonl(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "mod.py"
+    path.write_text(SOURCE)
+    out, err, code = run_main(monkeypatch, capsys, "--check", "--format", "jsonl", path)
+    assert code == 1
+    # messages go to stderr
+    assert "renamed 'c' to 'b'" in err
+    f, g = map(json.loads, out.splitlines())
+    assert (f["path"], f["qname"], g["qname"]) == (str(path), "f", "g")
+    assert [i["kind"] for i in f["issues"]] == ["reformat", "renamed-parameter"]
+    assert g["issues"] == [
+        {"kind": "missing-parameter", "message": "'x' is not documented"},
+        {"kind": "extra-parameter", "message": "'y' is not a parameter"},
+        {"kind": "extra-parameter", "message": "'z' is not a parameter"},
+    ]
+    assert g["replacement"] is None
+    lines = SOURCE.splitlines(True)
+    assert (f["start_line"], f["start_column"]) == (3, 8)
+    assert (f["end_line"], f["end_column"]) == (10, 5)
+    new = (
+        "".join(lines[:2])
+        + lines[2][:7]
+        + f["replacement"]
+        + lines[9][4:]
+        + "".join(lines[10:])
+    )
+    assert new == SOURCE.replace("a: int", "a : int").replace("c : int", "b : int")
+
+
+def test_sarif(tmp_path, monkeypatch, capsys):
+    (tmp_path / "mod.py").write_text(SOURCE)
+    (tmp_path / "clean.py").write_text("def h():\n    pass\n")
+    monkeypatch.chdir(tmp_path)
+    out, _, code = run_main(monkeypatch, capsys, "--check", "--format", "sarif", ".")
+    assert code == 1
+    (run,) = json.loads(out)["runs"]
+    results = run["results"]
+    assert [r["ruleId"] for r in results] == [
+        "reformat",
+        "renamed-parameter",
+        "missing-parameter",
+        "extra-parameter",
+        "extra-parameter",
+    ]
+    location = results[0]["locations"][0]["physicalLocation"]
+    assert location["artifactLocation"]["uri"] == "mod.py"
+    assert location["region"]["startLine"] == 3
+    (fix,) = results[0]["fixes"]
+    assert (
+        "b : int"
+        in fix["artifactChanges"][0]["replacements"][0]["insertedContent"]["text"]
+    )
+    assert "fixes" not in results[1]
+
+    (tmp_path / "mod.py").unlink()
+    out, _, code = run_main(monkeypatch, capsys, "--check", "--format", "sarif", ".")
+    assert code == 0
+    assert json.loads(out)["runs"][0]["results"] == []
+
+
+def test_format_needs_check(tmp_path, monkeypatch, capsys):
+    _, err, code = run_main(monkeypatch, capsys, "--format", "jsonl", tmp_path)
+    assert code == 2
+    assert "--format jsonl needs --check" in err
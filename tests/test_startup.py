@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import pytest
+
+CLEAN = '''
+def f(a):
+    """
+    Summary.
+
+    Parameters
+    ----------
+    a : int
+        a number
+    """
+'''
+
+
+def imported_after(code):
+    res = subprocess.run(
+        [sys.executable, "-c", code + "\nimport sys; print(' '.join(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(res.stdout.split())
+
+
+def test_import_velin_is_lazy():
+    modules = imported_after("import velin")
+    assert {"velin.ref", "numpydoc", "black", "there", "pygments"}.isdisjoint(modules)
+
+
+@pytest.mark.parametrize("args", [["--check"], ["--check", "--black"]])
+def test_clean_check_does_not_import_black(tmp_path, args):
+    path = tmp_path / "clean.py"
+    path.write_text(CLEAN)
+    code = f"""
+import sys
+from velin.ref import main
+sys.argv = ["velin", "--no-cache", *{args!r}, {str(path)!r}]
+try:
+    main()
+except SystemExit as e:
+    assert not e.code, e.code
+"""
+    modules = imported_after(code)
+    assert {"black", "pygments", "concurrent.futures.process"}.isdisjoint(modules)
@@ -0,0 +1,71 @@
+import subprocess
+
+import pytest
+
+from velin.walk import python_files
+
+FILES = [
+    "a.py",
+    "notes.txt",
+    "pkg/b.py",
+    "pkg/b_pb2.py",
+    "pkg/keep_pb2.py",
+    "pkg/gen/c.py",
+    "pkg/sub/d.py",
+    "pkg/sub/local.py",
+    "build/e.py",
+    "node_modules/f.py",
+    "env/lib/g.py",
+    "env/pyvenv.cfg",
+    "docs/build.py",
+]
+
+
+@pytest.fixture
+def repo(tmp_path):
+    for name in FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "h.py").write_text("")
+    (tmp_path / ".gitignore").write_text("# generated\n*_pb2.py\n!keep_pb2.py\ngen/\n")
+    (tmp_path / "pkg" / "sub" / ".gitignore").write_text("/local.py\n")
+    return tmp_path
+
+
+def relative(root, files):
+    return [p.relative_to(root).as_posix() for p in files]
+
+
+def test_python_files(repo):
+    assert relative(repo, python_files(repo)) == [
+        "a.py",
+        "docs/build.py",
+        "pkg/b.py",
+        "pkg/keep_pb2.py",
+        "pkg/sub/d.py",
+    ]
+    # .gitignore files above the walked directory apply.
+    assert relative(repo, python_files(repo / "pkg")) == [
+        "pkg/b.py",
+        "pkg/keep_pb2.py",
+        "pkg/sub/d.py",
+    ]
+    assert len(list(python_files(repo, exclude=False))) == len(FILES) - 2 + 1
+
+
+def test_git_files(repo):
+    (repo / ".git" / "h.py").unlink()
+    (repo / ".git").rmdir()
+    subprocess.run(["git", "init", "-q"], cwd=repo, check=True)
+    assert relative(repo, python_files(repo, use_git=True)) == [
+        "a.py",
+        "build/e.py",
+        "docs/build.py",
+        "env/lib/g.py",
+        "node_modules/f.py",
+        "pkg/b.py",
+        "pkg/keep_pb2.py",
+        "pkg/sub/d.py",
+    ]
@@ -10,13 +10,35 @@ Tools to automatically reformat docstrings based using numpydoc format.
 
 """
 
+import sys
 import textwrap
 
-from there import print
+__version__ = "0.0.12"
 
-from velin.ref import NumpyDocString, main
 
-__version__ = "0.0.12"
+def main():
+    argv = sys.argv[1:]
+    if "--use-daemon" in argv and argv[:1] != ["daemon"]:
+        # let the daemon do the work without importing velin.ref at all.
+        from velin.daemon import run_client
+
+        argv = [a for a in argv if a != "--use-daemon"]
+        code = run_client(argv)
+        if code is not None:
+            sys.exit(code)
+
+    # imported lazily to keep `import velin` (and the `velin` command) fast.
+    from velin.ref import main
+
+    return main(argv)
+
+
+def __getattr__(name):
+    if name == "NumpyDocString":
+        from velin.ref import NumpyDocString
+
+        return NumpyDocString
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def parse(input):
@@ -26,36 +48,78 @@ def parse(input):
     For now only return a list of tokens
 
     """
-    tokens = []
-    for line in input.splitlines():
-        tokens.extend(line.split(" "))
-    return tokens
+    return list(_words(input.splitlines()))
 
 
-def transform(tokens):
+def _words(lines):
+    for line in lines:
+        yield from line.split(" ")
+
+
+def transform(tokens, width=80):
     """
     Accumulate tokens in lines.
 
-    Add token (and white spaces) to a line until it overflow 80 chars.
+    Add token (and white spaces) to a line until it overflow ``width`` chars.
     """
-    lines = []
+    return list(_fill(tokens, width))
+
+
+def _fill(tokens, width=80):
     current_line = []
+    # length of current_line, with a space after each token.
+    length = 0
     for t in tokens:
-        if sum([len(x) + 1 for x in current_line]) + len(t) > 80:
-            lines.append(current_line)
+        if length + len(t) > width:
+            yield current_line
             current_line = []
+            length = 0
         current_line.append(t)
+        length += len(t) + 1
     if current_line:
-        lines.append(current_line)
-    return lines
+        yield current_line
 
 
 def format(lines):
-    s = ""
+    return "\n".join(" ".join(line) for line in lines)
+
+
+def reflow(lines, width=80):
+    """
+    Refill the words of ``lines`` into lines of at most ``width`` chars.
+
+    ``lines`` is an iterable of lines with their line endings, like a text file;
+    the new lines are generated without line endings, so that a large file can
+    be reflowed without being read into memory.
+
+    Same as ``format(transform(parse(...)))`` applied twice, which only differs
+    from a single pass by dropping a trailing empty line.
+    """
+    pending = None
+    for words in _fill(_words(_splitlines(lines)), width):
+        if pending is not None:
+            yield pending
+        pending = " ".join(words)
+    if pending:
+        yield pending
+
+
+def _splitlines(lines):
+    # as str.splitlines would split the whole text, files only split on \n.
     for line in lines:
-        s = s + " ".join(line)
-        s = s + "\n"
-    return s[:-1]
+        yield from line.splitlines()
+
+
+def reformat_stream(input, output, width=80):
+    """
+    Write the reflowed lines of the text file ``input`` to ``output``.
+    """
+    first = True
+    for line in reflow(input, width):
+        if not first:
+            output.write("\n")
+        output.write(line)
+        first = False
 
 
 def compute_indents(lines):
@@ -85,7 +149,66 @@ class TryNext(Exception):
     pass
 
 
+# The parsers below work on a shared list of lines and an integer cursor:
+# ``_parse(lines, i)`` parses from ``lines[i]`` and returns the position where
+# it stopped, instead of a copy of the remaining lines. ``parse(lines)`` is
+# kept for backward compatibility and returns the remaining lines.
+#
+# ``lines`` is a `_Lines`, classified once so that `Doc.parse` picks the parser
+# for each position from ``_PARSERS`` instead of trying them in turn.
+
+# What line ``i`` starts, see `_Lines`.
+_HEADER, _BLANK, _DOCTEST, _PARAGRAPH, _RAW = range(5)
+
+
+class _Lines(list):
+    """
+    Lines of a document, with what each of them starts.
+
+    ``kinds[i]`` is, by order of precedence, ``_HEADER`` if lines ``i`` and
+    ``i + 1`` are a title and its underline, ``_BLANK``, ``_DOCTEST`` for a
+    ``>>>`` prompt, ``_PARAGRAPH`` for an unindented line not followed by an
+    indented one, or ``_RAW``. ``paragraphs[i]`` is whether a paragraph can start
+    on line ``i``, regardless of the precedence.
+    """
+
+    def __init__(self, lines):
+        super().__init__(lines)
+        n = len(self)
+        self.kinds = kinds = [_RAW] * n
+        self.paragraphs = paragraphs = [False] * n
+        for i, line in enumerate(self):
+            nxt = self[i + 1] if i + 1 < n else None
+            paragraphs[i] = paragraph = (
+                bool(line)
+                and not line.startswith(" ")
+                and not (nxt and nxt.startswith(" ") and nxt.strip())
+            )
+            if (
+                nxt
+                and len(nxt) == len(line)
+                and nxt[0] in "-=~`"
+                and nxt.count(nxt[0]) == len(nxt)
+            ):
+                kinds[i] = _HEADER
+            elif not line.strip():
+                kinds[i] = _BLANK
+            elif line.startswith((">>>", "    >>>")):
+                kinds[i] = _DOCTEST
+            elif paragraph:
+                kinds[i] = _PARAGRAPH
+
+
+def _is_header(lines, i):
+    """
+    Whether ``Header.parse(lines[i:])`` would succeed.
+    """
+    return lines.kinds[i] == _HEADER
+
+
 class Header:
+    __slots__ = ("title", "level")
+
     def __init__(self, title, level):
         self.title = title
         # if str(title) not in NumpyDocString.sections.keys():
@@ -104,26 +227,32 @@ class Header:
 
     @classmethod
     def parse(cls, lines):
-        if len(lines) < 2:
+        node, i, wn = cls._parse(lines, 0)
+        return node, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
+        if len(lines) - i < 2:
             raise TryNext
-        assert lines
+        l0, l1 = lines[i], lines[i + 1]
         warnings = []
-        title, _, wn = Raw.parse(lines)
+        # titles are few distinct strings repeated in every docstring.
+        title, wn = Raw(sys.intern(l0)), []
         lgth = len(title.lines[0])
         if (
-            len(set(lines[1])) == 1
-            and len(lines[1]) != 1
-            and len(lines[1]) != lgth
-            and ">>>" not in lines[0]
-            and "::" not in lines[1]
+            len(set(l1)) == 1
+            and len(l1) != 1
+            and len(l1) != lgth
+            and ">>>" not in l0
+            and "::" not in l1
         ):
 
             warnings.append("======= WRONG LEN? ======")
-            warnings.append("L0: " + lines[0])
-            warnings.append("L1: " + lines[1])
+            warnings.append("L0: " + l0)
+            warnings.append("L1: " + l1)
             warnings.append("=========================")
-        level = allunders(lines[1], lgth)
-        return cls(title, level), lines[2:], wn
+        level = allunders(l1, lgth)
+        return cls(title, level), i + 2, wn
 
 
 def allunders(line, lenght):
@@ -136,6 +265,8 @@ def allunders(line, lenght):
 
 
 class Any:
+    __slots__ = ("lines",)
+
     def __init__(self, line):
         assert isinstance(line, str)
         self.lines = [line]
@@ -150,27 +281,29 @@ class Any:
     def parse(cls, lines):
         return cls(lines[0]), lines[1:], []
 
+    @classmethod
+    def _parse(cls, lines, i):
+        return cls(lines[i]), i + 1, []
+
 
 class Raw(Any):
-    pass
+    __slots__ = ()
 
 
 class RawTilNextHeader:
+    __slots__ = ("items",)
+
     @classmethod
     def parse(cls, lines):
-        ll = []
-        for i, line in enumerate(lines):
-            try:
-                Header.parse(lines[i:])
-                break
-            except TryNext:
-                pass
+        node, i, wn = cls._parse(_Lines(lines), 0)
+        return node, lines[i:], wn
 
-            ll.append(line)
-        else:
-            return cls(ll), [], []
-
-        return cls(ll), lines[i:], []
+    @classmethod
+    def _parse(cls, lines, i):
+        for j in range(i, len(lines)):
+            if _is_header(lines, j):
+                return cls(lines[i:j]), j, []
+        return cls(lines[i:]), len(lines), []
 
     def __init__(self, items):
         assert isinstance(items, list)
@@ -187,18 +320,26 @@ class RawTilNextHeader:
 
 
 class DescriptionList:
+    __slots__ = ("items",)
+
     @classmethod
     def parse(cls, lines):
+        node, i, wn = cls._parse(_Lines(lines), 0)
+        return node, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
         dct = {}
         key, values = None, []
-        for i, line in enumerate(lines):
-            try:
-                Header.parse(lines[i:])
+        # like the original slicing version, stop on the last line if there is
+        # no header.
+        end = len(lines) - 1
+        for j in range(i, len(lines)):
+            if _is_header(lines, j):
                 dct[key] = values
+                end = j
                 break
-            except TryNext:
-                pass
-
+            line = lines[j]
             if not line.startswith(" "):
                 dct[key] = values
                 key, values = line.strip(), []
@@ -208,7 +349,7 @@ class DescriptionList:
                 values.append(line)
         if None in dct:
             del dct[None]
-        return cls(dct), lines[i:], []
+        return cls(dct), end, []
 
     def __init__(self, items):
         assert isinstance(items, dict)
@@ -237,6 +378,8 @@ class DescriptionList:
 
 
 class Listing:
+    __slots__ = ("listing",)
+
     @classmethod
     def parse(cls, lines):
         assert "," in lines[0], lines[0]
@@ -259,16 +402,11 @@ class Listing:
 
 
 class Base:
+    __slots__ = ()
+
     def attrs(self):
-        stuff = {}
-        for it in dir(self):
-            if it.startswith("_"):
-                continue
-            att = getattr(self, it)
-            if callable(att):
-                continue
-            stuff[it] = att
-        return stuff
+        # sorted, in the order dir() used to list them.
+        return {name: getattr(self, name) for name in sorted(self.__slots__)}
 
     def __repr__(self):
         return (
@@ -279,36 +417,39 @@ class Base:
 
 
 class EntryParser(Base):
+    __slots__ = ("head", "t", "rest")
+
     @classmethod
     def parse(cls, lines):
-        if len(lines) == 1:
-            l0, l1 = lines[0], ""
-            rest = []
-        elif len(lines) < 3:
-            l0, l1 = lines
-            rest = []
-        else:
-            l0, l1, *rest = lines
+        entries, i = cls._parse(lines, 0)
+        return entries, lines[i:]
+
+    @classmethod
+    def _parse(cls, lines, i):
+        n = len(lines)
+        l0 = lines[i]
+        l1 = lines[i + 1] if i + 1 < n else ""
         indent = len(l1) - len(l1.lstrip())
-        i = 0
         if indent:
             cont = [l1]
-            for i, line in enumerate(rest):
+            end = n
+            for j in range(i + 2, n):
+                line = lines[j]
                 if line.startswith(" " * indent) or not line.strip():
                     cont.append(line)
                 else:
+                    end = j
                     break
-            else:
-                i += 1
         else:
-            i = 0
             cont = []
-            rest = lines[1:]
+            end = i + 1
         if ":" in l0:
             try:
                 head, t = (x.strip() for x in l0.split(":", maxsplit=1))
             except ValueError:
-                print("... Entry TryNext", lines[:5])
+                from there import print
+
+                print("... Entry TryNext", lines[i : i + 5])
                 raise TryNext
         else:
             head, t = l0.strip(), ""
@@ -316,12 +457,14 @@ class EntryParser(Base):
         if " " in head:
             if not t and not cont:
                 # print('... list of things ? ', head)
-                return [cls(h.strip(), "", []) for h in head.split(",")], rest[i:]
+                return [cls(h.strip(), "", []) for h in head.split(",")], end
 
             if "See Also" in head:
-                print("-------------->", lines[:3])
+                from there import print
+
+                print("-------------->", lines[i : i + 3])
 
-        return [cls(head, t, cont)], rest[i:]
+        return [cls(head, t, cont)], end
 
     def __init__(self, head, t, rest):
         # assert (head.strip() or t.strip() or [r.strip() for r in rest])
@@ -358,25 +501,29 @@ class EntryParser(Base):
 
 
 class DeflistParser(Base):
+    __slots__ = ("entries",)
+
     def __init__(self, entries):
         self.entries = entries
 
     @classmethod
     def parse(cls, lines):
+        node, i = cls._parse(_Lines(lines), 0)
+        return node, lines[i:]
+
+    @classmethod
+    def _parse(cls, lines, i):
         ents = []
-        while lines:
-            if not lines[0].strip():
-                lines = lines[1:]
+        while i < len(lines):
+            if not lines[i].strip():
+                i += 1
                 continue
-            try:
-                Header.parse(lines)
+            if _is_header(lines, i):
                 break
-            except TryNext:
-                pass
-            e, lines = EntryParser.parse(lines)
+            e, i = EntryParser._parse(lines, i)
             ents.extend(e)
 
-        return cls(ents), lines
+        return cls(ents), i
 
     def __str__(self):
         return "\n".join(str(x) for x in self.entries)
@@ -391,18 +538,27 @@ class DeflistParser(Base):
 
 
 class Mapping:
+    __slots__ = ("mapping",)
+
     @classmethod
     def parse(cls, lines):
+        node, i, wn = cls._parse(_Lines(lines), 0)
+        return node, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
         mapping = {}
         k = None
-        for i, line in enumerate(lines):
+        # like the original slicing version, stop on the last line if there is
+        # no header.
+        end = len(lines) - 1
+        for j in range(i, len(lines)):
+            line = lines[j]
             if not line.strip():
                 continue
-            try:
-                Header.parse(lines[i:])
+            if _is_header(lines, j):
+                end = j
                 break
-            except TryNext:
-                pass
             if line.startswith(" ") and k:
                 try:
                     mapping[k.strip()] += line.strip()
@@ -419,7 +575,7 @@ class Mapping:
                 for k in line.split(","):
                     mapping[k.strip()] = None
 
-        return cls(mapping), lines[i:], []
+        return cls(mapping), end, []
 
     def __init__(self, mapping):
         self.mapping = mapping
@@ -450,19 +606,22 @@ class Mapping:
 
 
 class CodeBlock:
+    __slots__ = ("lines",)
+
     @classmethod
     def parse(cls, lines):
-        if not lines[0].startswith((">>>", "    >>>")):
+        node, i, wn = cls._parse(lines, 0)
+        return node, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
+        if not lines[i].startswith((">>>", "    >>>")):
             raise TryNext
 
-        _lines = []
-        for i, line in enumerate(lines):
-            if not line.strip():
-                break
-            _lines.append(line)
-        else:
-            return cls(_lines), [], []
-        return cls(_lines), lines[i:], []
+        for j in range(i, len(lines)):
+            if not lines[j].strip():
+                return cls(lines[i:j]), j, []
+        return cls(lines[i:]), len(lines), []
 
     def __init__(self, lines):
         self.lines = lines
@@ -478,33 +637,24 @@ class CodeBlock:
 
 
 class Doc:
+    __slots__ = ("nodes", "name", "sig", "backrefs")
+
     @classmethod
     def parse(cls, lines, *, name=None, sig=None):
+        lines = _Lines(lines)
         parsed = []
         warnings = []
-        while lines:
-            for t in (
-                Section.parse,
-                Header.parse,
-                BlankLine.parse,
-                CodeBlock.parse,
-                Paragraph.parse,
-                RawTilNextHeader.parse,
-                failed,
-            ):
-                try:
-                    node, lines_, wn = t(lines)
-                    warnings.extend(wn)
-                    if isinstance(node, list):
-                        parsed.extend(node)
-                    else:
-                        parsed.append(node)
-                    if len(lines_) >= len(lines):
-                        raise ValueError("Could not parse", lines)
-                    lines = lines_
-                    break
-                except TryNext:
-                    pass
+        i = 0
+        while i < len(lines):
+            node, j, wn = _PARSERS[lines.kinds[i]](lines, i)
+            warnings.extend(wn)
+            if isinstance(node, list):
+                parsed.extend(node)
+            else:
+                parsed.append(node)
+            if j <= i:
+                raise ValueError("Could not parse", lines[i:])
+            i = j
         return cls(parsed, name=name, sig=sig), warnings
 
     def __init__(self, nodes, name=None, sig=None):
@@ -533,6 +683,8 @@ class Doc:
         elif isinstance(node, DeflistParser):
             return [x.head for x in node.entries]
         else:
+            from there import print
+
             print("not a mapping", repr(node))
             pass
 
@@ -596,10 +748,17 @@ class Section:
     start with a header, but have custom parsing because we know about it in numpydoc.
     """
 
+    __slots__ = ("header",)
+
     @classmethod
     def parse(cls, lines):
+        nodes, i, wn = cls._parse(_Lines(lines), 0)
+        return nodes, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
         warnings = []
-        header, rest, wn = Header.parse(lines)
+        header, rest, wn = Header._parse(lines, i)
         warnings.extend(wn)
         aliases = {
             "Return": "Returns",
@@ -630,22 +789,24 @@ class Section:
             "Arguments",
         ):
             try:
-                try:
-                    core, rest, _ = Paragraph.parse(rest)
-                except TryNext:
-                    core, rest = DeflistParser.parse(rest)
+                if lines.paragraphs[rest]:
+                    core, rest, _ = Paragraph._parse(lines, rest)
+                else:
+                    core, rest = DeflistParser._parse(lines, rest)
             except TryNext:
-                core, rest, wn = DescriptionList.parse(rest)
+                core, rest, wn = DescriptionList._parse(lines, rest)
                 warnings.extend(wn)
             return [cls(header), core], rest, warnings
         elif header.title.lines[0] in ("See Also", "Returns", "See also"):
             if header.title.lines[0] == "See also":
                 header.title.lines[0] = "See Also"
             try:
-                core, rest = DeflistParser.parse(rest)
+                core, rest = DeflistParser._parse(lines, rest)
             except TryNext:
+                from there import print
+
                 print("Deflist failed trying Mapping... ")
-                core, rest, wn = Mapping.parse(rest)
+                core, rest, wn = Mapping._parse(lines, rest)
                 warnings.extend(wn)
                 # core, rest, wn = DescriptionList.parse(rest)
                 # warnings.extend(wn)
@@ -673,24 +834,28 @@ class Section:
 
 
 class Paragraph:
+    __slots__ = ("lines",)
+
     @classmethod
     def parse(cls, lines):
-        _lines = []
-        l0 = lines[0]
+        node, i, wn = cls._parse(lines, 0)
+        return node, lines[i:], wn
+
+    @classmethod
+    def _parse(cls, lines, i):
+        l0 = lines[i]
         if not l0 or l0.startswith(" "):
             raise TryNext
-        if len(lines) >= 2:
-            if lines[1].startswith(" ") and lines[1].strip():
+        if len(lines) - i >= 2:
+            if lines[i + 1].startswith(" ") and lines[i + 1].strip():
                 # second line indented this _is_ a deflist
                 raise TryNext
-        for i, line in enumerate(lines):
-            if line and not line.startswith(" "):
-                _lines.append(line)
-            else:
-                break
-        if not _lines:
-            raise TryNext
-        return cls(_lines), lines[i + 1 :], []
+        # the line ending the paragraph is consumed, as is the last line.
+        for j in range(i + 1, len(lines)):
+            line = lines[j]
+            if not line or line.startswith(" "):
+                return cls(lines[i:j]), j + 1, []
+        return cls(lines[i:]), len(lines), []
 
     def __init__(self, lines):
         self.lines = lines
@@ -706,14 +871,29 @@ class Paragraph:
 
 
 class BlankLine:
+    """
+    Blank lines carry nothing, they all are the same instance.
+    """
+
+    __slots__ = ()
+    _instance = None
+
     @classmethod
     def parse(self, lines):
         if not lines[0].strip():
             return BlankLine(), lines[1:], []
         raise TryNext
 
-    def __init__(self):
-        pass
+    @classmethod
+    def _parse(cls, lines, i):
+        if not lines[i].strip():
+            return BlankLine(), i + 1, []
+        raise TryNext
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
 
     def __repr__(self):
         return f"<{self.__class__.__name__}>"
@@ -725,11 +905,21 @@ class BlankLine:
         return ""
 
 
+_PARSERS = {
+    _HEADER: Section._parse,
+    _BLANK: BlankLine._parse,
+    _DOCTEST: CodeBlock._parse,
+    _PARAGRAPH: Paragraph._parse,
+    _RAW: RawTilNextHeader._parse,
+}
+
+
 def failed(lines):
     raise ValueError("nothign managed to parse", lines)
 
 
 def parsedoc(doc, *, name=None, sig=None):
+    from velin.ref import NumpyDocString
 
     try:
         NumpyDocString(doc)
@@ -809,8 +999,10 @@ def dedentfirst(docstring):
     return "\n".join([dedent(l0)] + ln)
 
 
-def reformat(input):
-    return format(transform(parse(format(transform(parse(input))))))
+def reformat(input, width=80):
+    import io
+
+    return "\n".join(reflow(io.StringIO(input), width))
 
 
 # def main():
@@ -1,3 +1,3 @@
-from velin.ref import main
+from velin import main
 
 main()
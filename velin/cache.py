@@ -0,0 +1,336 @@
+"""
+On disk cache of the files vélin already knows are clean.
+
+Similar to black's cache: one cache file per combination of settings and
+versions of velin/numpydoc/black, holding the hashes of the file contents that
+did not need any change, and the size and modification time of the clean files
+so that they can be skipped without being read. This module purposely does not
+import numpydoc or black so that checking the cache is cheap.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, OrderedDict
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+# bump if the format of the cache files changes.
+CACHE_VERSION = 2
+
+# maximum number of clean file hashes kept per cache file, least recently used
+# are evicted first.
+MAX_ENTRIES = 100_000
+
+# maximum number of cache files (settings/version combinations) kept in the
+# cache directory, least recently used are removed first.
+MAX_CACHE_FILES = 8
+
+
+def get_cache_dir():
+    """
+    Directory where vélin stores its caches.
+
+    ``$VELIN_CACHE_DIR`` if set, otherwise ``velin`` in ``$XDG_CACHE_HOME``
+    (default ``~/.cache``).
+    """
+    if path := os.environ.get("VELIN_CACHE_DIR"):
+        return Path(path)
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "velin"
+
+
+def package_version(name):
+    if name == "velin":
+        import velin
+
+        return velin.__version__
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def settings_key(settings):
+    """
+    Hash of the settings and versions of everything that can change the output.
+    """
+    payload = {
+        "cache": CACHE_VERSION,
+        "python": sys.version_info[:2],
+        "versions": {
+            name: package_version(name) for name in ("velin", "numpydoc", "black")
+        },
+        "settings": settings,
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=repr).encode()
+    ).hexdigest()[:32]
+
+
+def file_key(data, obj_p):
+    """
+    Key of a file in the cache, its content and the objects skipped in it.
+    """
+    h = hashlib.sha256(data.encode())
+    for p in sorted(obj_p or ()):
+        h.update(b"\0" + p.encode())
+    return h.hexdigest()
+
+
+def _atomic_write(path, text):
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Cache:
+    """
+    Set of file keys known to be clean for a given set of settings.
+
+    Use `Cache.read` to load the cache for some settings, `lookup`,
+    `is_clean` and `mark_clean` while processing files, and `write` to save it.
+    """
+
+    def __init__(self, path, entries=None, files=None):
+        self.path = path
+        # file key -> last time it was used
+        self.entries = entries or {}
+        # absolute path -> [size, mtime_ns, file key, skipped objects]
+        self.files = files or {}
+        self._now = int(time.time())
+        self._dirty = False
+
+    @classmethod
+    def read(cls, settings, directory=None):
+        if directory is None:
+            directory = get_cache_dir()
+        path = Path(directory) / f"cache.{settings_key(settings)}.json"
+        try:
+            with open(path) as f:
+                content = json.load(f)
+            entries, files = content["entries"], content["files"]
+            assert isinstance(entries, dict) and isinstance(files, dict)
+        except Exception:
+            entries, files = {}, {}
+        return cls(path, entries, files)
+
+    def lookup(self, path, obj_p):
+        """
+        Key of the content ``path`` had when it was last marked clean, and
+        whether it still has the same size and modification time, in which case
+        it is clean without reading it.
+        """
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None or entry[3] != sorted(obj_p or ()):
+            return None, False
+        size, mtime_ns, key, _ = entry
+        if key not in self.entries:
+            return None, False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, False
+        return key, (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+
+    def is_clean(self, key):
+        if key not in self.entries:
+            return False
+        if self.entries[key] != self._now:
+            self.entries[key] = self._now
+            self._dirty = True
+        return True
+
+    def mark_clean(self, key, path=None, obj_p=None, stat=None):
+        """
+        Record that the content with ``key`` is clean, and that the file
+        ``path`` with ``stat`` (its size and modification time when read) has
+        this content.
+        """
+        self.entries[key] = self._now
+        self._dirty = True
+        # files modified in the current second could change again unnoticed.
+        if path is not None and stat[1] < self._now * 1_000_000_000:
+            self.files[os.path.abspath(path)] = [*stat, key, sorted(obj_p or ())]
+
+    def write(self):
+        """
+        Save the cache, evicting old entries and old cache files.
+
+        Failing to write the cache is not an error.
+        """
+        if not self._dirty:
+            return
+        entries = self.entries
+        if len(entries) > MAX_ENTRIES:
+            keep = sorted(entries, key=entries.__getitem__)[-MAX_ENTRIES:]
+            entries = {k: entries[k] for k in keep}
+        files = {p: e for p, e in self.files.items() if e[2] in entries}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            _atomic_write(self.path, json.dumps({"entries": entries, "files": files}))
+            self._dirty = False
+            _prune(self.path.parent, "cache.*.json")
+        except OSError:
+            pass
+
+
+def _prune(directory, pattern):
+    """
+    Remove the least recently written files matching ``pattern``, beyond
+    ``MAX_CACHE_FILES``.
+    """
+    others = sorted(directory.glob(pattern), key=lambda p: p.stat().st_mtime)
+    for old in others[:-MAX_CACHE_FILES]:
+        old.unlink()
+
+
+# counters reported by --stats, merged back from worker processes.
+STATS = Counter()
+
+# in process caches by name, see `LRUCache`.
+CACHES = {}
+
+
+class LRUCache:
+    """
+    Bounded, in process, least recently used cache.
+
+    Caches register themselves by name in ``CACHES`` so that entries computed
+    in worker processes can be sent back to the main process (`pop_added`),
+    and count their hits and misses in ``STATS``. They can be persisted with
+    `load` and `dump`; keys and values need to be JSON serialisable.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.added = []
+        # file the cache was last loaded from or dumped to, and its mtime.
+        self._loaded = None
+        # directory to load the cache from on first use, see `load`.
+        self._pending = None
+        CACHES[name] = self
+
+    @property
+    def data(self):
+        if self._pending is not None:
+            self._load()
+        return self._data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        try:
+            value = self.data[key]
+        except KeyError:
+            STATS[self.name + "_misses"] += 1
+            return None
+        self._data.move_to_end(key)
+        STATS[self.name + "_hits"] += 1
+        return value
+
+    def put(self, key, value):
+        data = self.data
+        data[key] = value
+        data.move_to_end(key)
+        self.added.append((key, value))
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def update(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def pop_added(self):
+        added, self.added = self.added, []
+        return added
+
+    def path(self, directory=None):
+        if directory is None:
+            directory = get_cache_dir()
+        return Path(directory) / f"{self.name}.{settings_key({})}.json"
+
+    def load(self, directory=None, eager=False):
+        """
+        Load the saved entries on first use, unless the file did not change
+        since last time.
+
+        Runs that don't look anything up don't pay for reading the file. With
+        ``eager`` the file is read now, for processes that fork workers.
+        """
+        self._pending = directory or get_cache_dir()
+        if eager:
+            self._load()
+
+    def _load(self):
+        path = self.path(self._pending)
+        self._pending = None
+        try:
+            loaded = (path, path.stat().st_mtime_ns)
+            if loaded == self._loaded:
+                return
+            with open(path) as f:
+                items = json.load(f)
+        except Exception:
+            return
+        for key, value in items[-self.maxsize :]:
+            self._data[key] = value
+        self.added = []
+        self._loaded = loaded
+
+    def dump(self, directory=None):
+        """
+        Save the cache if entries were added, evicting old cache files.
+
+        Failing to write it is not an error.
+        """
+        if not self.added:
+            return
+        path = self.path(directory)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _atomic_write(path, json.dumps(list(self.data.items())))
+            self.added = []
+            self._loaded = (path, path.stat().st_mtime_ns)
+            _prune(path.parent, f"{self.name}.*.json")
+        except OSError:
+            pass
+
+
+def hit_rate(name):
+    hits, misses = STATS[name + "_hits"], STATS[name + "_misses"]
+    if not hits + misses:
+        return f"{name}: no lookups"
+    return f"{name}: {hits} hits, {misses} misses ({hits / (hits + misses):.1%})"
+
+
+def worker_state(before):
+    """
+    What a worker needs to send back to the main process after a task.
+
+    ``before`` is a copy of ``STATS`` at the start of the task.
+    """
+    return STATS - before, {
+        name: cache.pop_added() for name, cache in CACHES.items() if cache.added
+    }
+
+
+def merge_worker_state(state):
+    stats, added = state
+    STATS.update(stats)
+    for name, items in added.items():
+        CACHES[name].update(items)
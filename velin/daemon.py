@@ -0,0 +1,355 @@
+"""
+Long running vélin process, and the client used by ``velin --use-daemon``.
+
+``velin daemon`` imports numpydoc and black once, loads the on disk caches,
+and listens on a local Unix socket. Each request is handled in a forked child
+of this warm process, so that requests are isolated from each other (working
+directory, environment, global options) and can run concurrently.
+
+The socket is in a directory only accessible to the user, and the client
+checks that the daemon runs as the same user before sending anything. The
+client sends its arguments, working directory and the environment variables
+vélin and git read (`_FORWARDED_ENV`) as one JSON line, and receives frames: a
+one byte kind, a 4 bytes length and a payload.
+
+- ``o``/``e``: bytes written to stdout/stderr,
+- ``x``: JSON encoded exit status,
+- ``r``: the daemon runs another version of vélin, the client should run
+  locally.
+
+This module is imported by the client, it should stay cheap to import.
+"""
+
+import json
+import os
+import struct
+import sys
+
+IDLE_TIMEOUT = 15 * 60
+
+# environment variables sent to the daemon: the ones used to find the caches,
+# and the ones git reads for --since, --staged and --git-files.
+_FORWARDED_ENV = {
+    "HOME",
+    "PATH",
+    "LANG",
+    "LC_ALL",
+    "LC_CTYPE",
+    "VELIN_CACHE_DIR",
+    "XDG_CACHE_HOME",
+    "XDG_CONFIG_HOME",
+    "GIT_DIR",
+    "GIT_WORK_TREE",
+    "GIT_INDEX_FILE",
+    "GIT_COMMON_DIR",
+    "GIT_OBJECT_DIRECTORY",
+    "GIT_ALTERNATE_OBJECT_DIRECTORIES",
+    "GIT_CEILING_DIRECTORIES",
+    "GIT_CONFIG_GLOBAL",
+    "GIT_CONFIG_SYSTEM",
+    "GIT_CONFIG_NOSYSTEM",
+}
+
+
+def socket_path():
+    """
+    Path of the daemon socket, ``$VELIN_DAEMON_SOCKET`` if set.
+
+    Otherwise ``daemon.sock`` in a ``velin-<uid>`` directory of
+    ``$XDG_RUNTIME_DIR``, or of the temporary directory, created private by the
+    daemon.
+    """
+    if path := os.environ.get("VELIN_DAEMON_SOCKET"):
+        return path
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if not base:
+        import tempfile
+
+        base = tempfile.gettempdir()
+    return os.path.join(base, f"velin-{os.getuid()}", "daemon.sock")
+
+
+def _private_dir(directory):
+    """
+    Create ``directory`` only accessible to the user, or check that it is.
+    """
+    import stat
+
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        sys.exit(f"velin: {directory} must be a directory only accessible to you")
+
+
+def _same_user(sock, path):
+    """
+    Whether the process listening on ``sock``, connected to ``path``, runs as
+    the current user.
+
+    Checked with ``SO_PEERCRED`` where available (Linux), from the owner of the
+    socket file otherwise.
+    """
+    import socket
+
+    uid = os.getuid()
+    try:
+        if os.stat(path).st_uid != uid:
+            return False
+    except OSError:
+        return False
+    if hasattr(socket, "SO_PEERCRED"):
+        size = struct.calcsize("3i")
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+        _, peer_uid, _ = struct.unpack("3i", creds)
+        return peer_uid == uid
+    return True
+
+
+def _forwarded_env(env):
+    return {name: value for name, value in env.items() if name in _FORWARDED_ENV}
+
+
+def _send(sock, kind, payload):
+    sock.sendall(kind + struct.pack("!I", len(payload)) + payload)
+
+
+def _recv_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ConnectionError("daemon closed the connection")
+    return data
+
+
+def run_client(argv):
+    """
+    Run vélin with ``argv`` in the daemon, streaming back its output.
+
+    Returns the exit status, or None if the daemon is not available and vélin
+    should run locally.
+    """
+    import socket
+
+    from velin import __version__
+
+    path = socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if not _same_user(sock, path):
+            print(
+                f"velin: {path} is not a daemon of yours, running locally",
+                file=sys.stderr,
+            )
+            sock.close()
+            return None
+    except OSError:
+        sock.close()
+        return None
+    request = {
+        "version": __version__,
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": _forwarded_env(os.environ),
+    }
+    with sock, sock.makefile("rb") as f:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        streams = {b"o": sys.stdout, b"e": sys.stderr}
+        try:
+            while True:
+                kind = _recv_exactly(f, 1)
+                (length,) = struct.unpack("!I", _recv_exactly(f, 4))
+                payload = _recv_exactly(f, length)
+                if kind in streams:
+                    stream = streams[kind]
+                    stream.flush()
+                    stream.buffer.write(payload)
+                    stream.buffer.flush()
+                elif kind == b"x":
+                    return json.loads(payload)
+                elif kind == b"r":
+                    return None
+        except ConnectionError:
+            print("velin: lost connection to the daemon", file=sys.stderr)
+            return 1
+
+
+def _version_on_disk():
+    """
+    Version of the installed vélin, which may differ from the running one.
+    """
+    import re
+
+    import velin
+
+    try:
+        with open(velin.__file__) as f:
+            m = re.search(r"^__version__ = [\"']([^\"']+)[\"']", f.read(), re.M)
+    except OSError:
+        return None
+    return m.group(1) if m else None
+
+
+def _handle(sock):
+    """
+    Handle one request, in a forked child of the daemon.
+    """
+    import io
+    import traceback
+
+    import velin
+
+    class _Frames(io.RawIOBase):
+        def __init__(self, kind):
+            self.kind = kind
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            _send(sock, self.kind, bytes(b))
+            return len(b)
+
+    with sock.makefile("rb") as f:
+        request = json.loads(f.readline())
+    if request["version"] != velin.__version__:
+        _send(sock, b"r", b"")
+        return
+    os.chdir(request["cwd"])
+    for name in _FORWARDED_ENV:
+        os.environ.pop(name, None)
+    os.environ.update(_forwarded_env(request["env"]))
+    sys.stdout = io.TextIOWrapper(
+        io.BufferedWriter(_Frames(b"o")), encoding="utf-8", line_buffering=True
+    )
+    sys.stderr = io.TextIOWrapper(
+        io.BufferedWriter(_Frames(b"e")), encoding="utf-8", line_buffering=True
+    )
+    from velin.ref import main
+
+    code = 0
+    try:
+        main(request["argv"])
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    if isinstance(code, str):
+        print(code, file=sys.stderr)
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _send(sock, b"x", json.dumps(code).encode())
+
+
+def serve(path=None, idle_timeout=IDLE_TIMEOUT):
+    """
+    Run the daemon until it is idle for ``idle_timeout`` seconds.
+
+    If the installed version of vélin changes, the daemon replaces itself with
+    a new one, listening on the same socket.
+    """
+    import socket
+    import socketserver
+    import time
+
+    import velin
+    import velin.examples_section_utils  # noqa: F401
+    import velin.ref
+    from velin.cache import CACHES
+
+    try:
+        import black  # noqa: F401
+    except ImportError:
+        pass
+
+    if path is None:
+        path = socket_path()
+        _private_dir(os.path.dirname(path))
+
+    def load_caches():
+        # forked children inherit the loaded entries.
+        for memo in CACHES.values():
+            memo.load(eager=True)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            _handle(self.request)
+
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        timeout = 1
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            probe.close()
+            sys.exit(f"velin: a daemon is already listening on {path}")
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    load_caches()
+    print(f"velin {velin.__version__} daemon listening on {path}", file=sys.stderr)
+
+    last_request = time.monotonic()
+    try:
+        with server:
+            while True:
+                n_requests = len(server.active_children or ())
+                server.handle_request()
+                if len(server.active_children or ()) > n_requests:
+                    last_request = time.monotonic()
+                    # children update the on disk caches, start the next ones
+                    # warm.
+                    load_caches()
+                if server.active_children:
+                    continue
+                if time.monotonic() - last_request > idle_timeout:
+                    print("velin daemon idle, exiting", file=sys.stderr)
+                    return
+                if _version_on_disk() != velin.__version__:
+                    print("velin was updated, restarting the daemon", file=sys.stderr)
+                    server.server_close()
+                    os.unlink(path)
+                    os.execv(
+                        sys.executable,
+                        [
+                            sys.executable,
+                            "-m",
+                            "velin",
+                            "daemon",
+                            "--socket",
+                            path,
+                            "--idle-timeout",
+                            repr(idle_timeout),
+                        ],
+                    )
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def serve_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="velin daemon",
+        description="Keep vélin warm in the background, for `velin --use-daemon`.",
+    )
+    parser.add_argument("--socket", default=None, help="Path of the socket")
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="Exit after this number of seconds without requests",
+    )
+    args = parser.parse_args(argv)
+    serve(args.socket, args.idle_timeout)
@@ -0,0 +1,166 @@
+"""
+Diffs of the changes made by vélin to a file.
+
+Only docstrings change, so instead of comparing the whole old and new files,
+the diff is built from the edits: each group of changed lines is compared on
+its own, and the context lines come from the original text. The output has the
+format of ``difflib.unified_diff``, but where lines repeat around a change the
+hunks can be aligned differently than when comparing the whole files.
+"""
+
+import sys
+from bisect import bisect_right
+from difflib import SequenceMatcher
+from itertools import accumulate
+
+
+def _ranges(edits, starts):
+    """
+    ``[first, last, edits]`` for each group of lines touched by ``edits``,
+    ``last`` excluded.
+    """
+    ranges = []
+    for edit in edits:
+        first = bisect_right(starts, edit.start) - 1
+        last = bisect_right(starts, edit.end)
+        if ranges and first < ranges[-1][1]:
+            ranges[-1][1] = last
+            ranges[-1][2].append(edit)
+        else:
+            ranges.append([first, last, [edit]])
+    return ranges
+
+
+def _new_lines(data, starts, first, last, edits):
+    """
+    Lines ``first`` to ``last`` of ``data`` once ``edits`` are applied.
+    """
+    parts = []
+    position = starts[first]
+    for start, end, text in edits:
+        parts += [data[position:start], text]
+        position = end
+    parts.append(data[position : starts[last]])
+    return "".join(parts).splitlines()
+
+
+def _opcodes(data, edits, old):
+    """
+    Opcodes of ``SequenceMatcher`` between the lines of ``data`` and of ``data``
+    with ``edits`` applied, with the new lines of the changes as a 6th item.
+    """
+    starts = [0, *accumulate(map(len, data.splitlines(True)))]
+    ranges = _ranges(edits, starts)
+    codes = []
+
+    def add(tag, i1, i2, j1, j2, new):
+        if tag == "equal" and codes and codes[-1][0] == "equal":
+            codes[-1][2], codes[-1][4] = i2, j2
+        elif i1 < i2 or j1 < j2:
+            codes.append([tag, i1, i2, j1, j2, new])
+
+    i = j = 0
+    for first, last, range_edits in ranges:
+        new = _new_lines(data, starts, first, last, range_edits)
+        add("equal", i, first, j, j + first - i, None)
+        j += first - i
+        sm = SequenceMatcher(None, old[first:last], new, autojunk=False)
+        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+            add(tag, first + i1, first + i2, j + j1, j + j2, new[j1:j2])
+        i, j = last, j + len(new)
+    add("equal", i, len(old), j, j + len(old) - i, None)
+    return codes
+
+
+def _grouped(codes, n):
+    """
+    Hunks of ``codes`` with ``n`` lines of context, as
+    ``SequenceMatcher.get_grouped_opcodes``.
+    """
+    if not codes:
+        return
+    tag, i1, i2, j1, j2, b = codes[0]
+    if tag == "equal":
+        codes[0] = [tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2, b]
+    tag, i1, i2, j1, j2, b = codes[-1]
+    if tag == "equal":
+        codes[-1] = [tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n), b]
+    group = []
+    for tag, i1, i2, j1, j2, b in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append([tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n), b])
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append([tag, i1, i2, j1, j2, b])
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _range(start, stop):
+    # like difflib._format_range_unified
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(data, edits, filename, n=3):
+    """
+    Lines of the unified diff between ``data`` and ``apply_edits(data, edits)``.
+
+    In the format of ``difflib.unified_diff``, with ``filename`` as both file
+    names.
+    """
+    if not edits:
+        return
+    old = data.splitlines()
+    started = False
+    for group in _grouped(_opcodes(data, edits, old), n):
+        if not started:
+            started = True
+            yield f"--- {filename}\n"
+            yield f"+++ {filename}\n"
+        first, last = group[0], group[-1]
+        yield f"@@ -{_range(first[1], last[2])} +{_range(first[3], last[4])} @@\n"
+        for tag, i1, i2, _, _, new in group:
+            if tag == "equal":
+                for line in old[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in old[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in new:
+                    yield "+" + line
+
+
+class DiffPrinter:
+    """
+    Print diffs to ``sys.stdout``, highlighted if ``color``.
+
+    pygments is imported, and its lexer and formatter created, on the first
+    highlighted diff only.
+    """
+
+    def __init__(self, color):
+        self.color = color
+        self._lexer = self._formatter = None
+
+    def print(self, lines):
+        code = "\n".join(lines)
+        out = sys.stdout
+        if self.color:
+            if self._lexer is None:
+                from pygments.formatters import TerminalFormatter
+                from pygments.lexers import DiffLexer
+
+                self._lexer, self._formatter = DiffLexer(), TerminalFormatter()
+            self._formatter.format(self._lexer.get_tokens(code), out)
+        else:
+            out.write(code)
+        out.write("\n")
@@ -1,19 +1,147 @@
+import ast
+import hashlib
+import re
+import uuid
 from collections import namedtuple
+from functools import lru_cache
 from itertools import chain, cycle
 
-import black
+from velin.cache import LRUCache, package_version
+
+# black formatted code blocks, see reformat. black is only imported on cache
+# misses, as it is by far the slowest import of velin.
+BLACK_CACHE = LRUCache("examples", maxsize=50_000)
+
+
+# functools.cache needs Python 3.9.
+@lru_cache(maxsize=None)  # noqa: UP033
+def _black_version():
+    return package_version("black")
+
+
+def _black_key(text):
+    """
+    Key of some code in ``BLACK_CACHE``, black is always run with its default mode.
+    """
+    key = repr((text, "default", _black_version()))
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
 
 
 def reformat(lines, indent=4):
     text = "\n".join(lines)
     if "doctest:" in text:
         return lines
+    key = _black_key(text)
+    if (formatted := BLACK_CACHE.get(key)) is not None:
+        return list(formatted)
+    import black
+
     try:
         mode = black.FileMode()
         mode.line_length -= indent + 4
-        return black.format_str(text, mode=black.FileMode()).splitlines()
+        formatted = black.format_str(text, mode=black.FileMode()).splitlines()
     except Exception as e:
         raise ValueError("could not reformat:" + repr(text)) from e
+    BLACK_CACHE.put(key, formatted)
+    # black is stable, so that re-parsing the reformatted examples (see
+    # ref._check_reparse) does not need to run it again.
+    BLACK_CACHE.put(_black_key("\n".join(formatted)), formatted)
+    return list(formatted)
+
+
+# code that can't be formatted together with other blocks: black directives,
+# and blocks starting with a string that black would treat as a docstring.
+_NOT_BATCHABLE = re.compile(r"fmt:|yapf:|^\s|^[rRbBuUfF]{0,2}['\"]")
+
+
+def reformat_batch(texts):
+    """
+    Format several blocks of code with a single black call.
+
+    The formatted blocks are only stored in ``BLACK_CACHE``, for `reformat` to
+    find them. Blocks that can't be formatted together are left out, as are
+    blocks that don't parse on their own: the batch separators could end up
+    in their strings or brackets, `reformat` reports their errors. If black
+    fails on the batch, or one of its formatted blocks doesn't parse, it is
+    split in halves until the failing blocks are isolated.
+    """
+    todo = {}
+    for text in texts:
+        if "doctest:" in text or _NOT_BATCHABLE.search(text):
+            continue
+        if not _parses(text):
+            continue
+        key = _black_key(text)
+        if key not in BLACK_CACHE and key not in todo:
+            todo[key] = text
+    if len(todo) < 2:
+        return
+    import black
+
+    _reformat_batch(list(todo.items()), black.FileMode())
+
+
+def _parses(text):
+    try:
+        ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+def _reformat_batch(items, mode):
+    if len(items) < 2:
+        return
+    import black
+
+    marker = f"# velin-batch-{uuid.uuid4().hex}\n"
+    try:
+        formatted = black.format_str(
+            "".join(text + "\n" + marker for _, text in items), mode=mode
+        )
+        parts = formatted.split(marker)
+        if len(parts) != len(items) + 1 or parts[-1]:
+            raise ValueError("block separators were not preserved")
+        if not all(_parses(part) for part in parts[:-1]):
+            raise ValueError("a block was not formatted on its own")
+    except Exception:
+        half = len(items) // 2
+        _reformat_batch(items[:half], mode)
+        _reformat_batch(items[half:], mode)
+        return
+    for (key, _), part in zip(items, parts):
+        formatted = part.strip("\n").splitlines()
+        BLACK_CACHE.put(key, formatted)
+        BLACK_CACHE.put(_black_key("\n".join(formatted)), formatted)
+
+
+def example_code_blocks(lines):
+    """
+    Code of the blocks of the Examples section of a (dedented) docstring.
+
+    This is a cheap approximation of what numpydoc passes to
+    `reformat_example_lines`, used to batch the calls to black.
+    """
+    for i, line in enumerate(lines[:-1]):
+        if line.strip().rstrip(":").lower() in ("examples", "example") and set(
+            lines[i + 1].strip()
+        ) == {"-"}:
+            start = i + 2
+            break
+    else:
+        return []
+    end = len(lines)
+    for j in range(start, len(lines) - 1):
+        l1, l2 = lines[j].strip(), lines[j + 1].strip()
+        if l1 and len(l2) >= 3 and set(l2) in ({"-"}, {"="}):
+            end = j
+            break
+    codes = []
+    for block in splitblank(lines[start:end]):
+        for in_, _ in splitcode(block):
+            if in_:
+                codes.append("\n".join(in_))
+    return codes
 
 
 def insert_promt(lines):
@@ -0,0 +1,145 @@
+"""
+Reading and writing the Python files reformatted by vélin.
+
+Files are decoded with the encoding Python would use for them (a coding
+cookie or a BOM, utf-8 otherwise) and universal newlines; big files are decoded
+straight from a memory map. They are written back with the same encoding, the
+line ending of their first line, and their permissions, through a temporary
+file renamed over the original, and only if their bytes change.
+"""
+
+import mmap
+import os
+import stat
+import tempfile
+from collections import namedtuple
+from io import BytesIO
+from tokenize import detect_encoding
+
+# files from this size are memory-mapped rather than read.
+MMAP_SIZE = 1024 * 1024
+
+# A decoded file, with what is needed to write it back, and the size and
+# modification time it had when read.
+Source = namedtuple("Source", ["text", "encoding", "newline", "size", "mtime_ns"])
+
+
+def _decode(buf):
+    """
+    Text of ``buf``, its encoding, and the line ending of its first line.
+    """
+    readline = buf.readline if isinstance(buf, mmap.mmap) else BytesIO(buf).readline
+    encoding, _ = detect_encoding(readline)
+    text = str(buf, encoding)
+    newline = "\n"
+    if "\r" in text:
+        i = text.find("\n")
+        if i > 0 and text[i - 1] == "\r":
+            newline = "\r\n"
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text, encoding, newline
+
+
+def read_file(path):
+    """
+    `Source` of the Python file ``path``, decoded with ``\\n`` line endings.
+    """
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size < MMAP_SIZE:
+            decoded = _decode(f.read())
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                decoded = _decode(buf)
+    return Source(*decoded, st.st_size, st.st_mtime_ns)
+
+
+class SourceWriter:
+    """
+    Write files atomically, leaving unchanged ones untouched.
+
+    New contents go to temporary files next to the originals. With ``sync``,
+    they are flushed to disk by batches of ``batch`` files before being renamed
+    over the originals, so that a crash leaves either the old or the new
+    content. Pending files are renamed by `flush`, or when leaving the
+    ``with`` block.
+    """
+
+    def __init__(self, sync=True, batch=128):
+        self.sync = sync
+        self.batch = batch
+        # (fd, temporary path, path)
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, path, text, source=None):
+        """
+        Write ``text`` to the existing file ``path``, return whether it changed.
+
+        ``source`` is the `Source` of the file if it was just read, the file is
+        read again otherwise.
+        """
+        path = os.path.realpath(path)
+        if source is None:
+            source = read_file(path)
+        old, encoding, newline = source[:3]
+        if text == old:
+            return False
+        data = text.replace("\n", newline).encode(encoding)
+        directory, name = os.path.split(path)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+            with open(fd, "wb", closefd=False) as f:
+                f.write(data)
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp)
+            raise
+        self._pending.append((fd, tmp, path))
+        if len(self._pending) >= self.batch:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Sync and rename the pending files.
+        """
+        pending, self._pending = self._pending, []
+        done = 0
+        try:
+            try:
+                if self.sync:
+                    for fd, _, _ in pending:
+                        os.fsync(fd)
+            finally:
+                for fd, _, _ in pending:
+                    os.close(fd)
+            for _, tmp, path in pending:
+                os.replace(tmp, path)
+                done += 1
+        finally:
+            for _, tmp, _ in pending[done:]:
+                os.unlink(tmp)
+        if self.sync:
+            for directory in {os.path.dirname(path) for _, _, path in pending}:
+                _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    # make the renames durable, not possible everywhere (Windows).
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,103 @@
+"""
+Ask the local git repository which files vélin needs to look at.
+"""
+
+import re
+import subprocess
+from pathlib import Path
+
+
+class GitError(Exception):
+    pass
+
+
+def _git(*args, cwd=None):
+    try:
+        res = subprocess.run(
+            ["git", *args], cwd=cwd, capture_output=True, text=True, check=False
+        )
+    except OSError as e:
+        raise GitError(f"could not run git: {e}") from e
+    if res.returncode:
+        raise GitError(res.stderr.strip() or f"git {args[0]} failed")
+    return res.stdout
+
+
+def toplevel(cwd=None):
+    return Path(_git("rev-parse", "--show-toplevel", cwd=cwd).strip())
+
+
+def changed_files(since, cwd=None):
+    """
+    Files added, modified or renamed since the revision ``since``.
+
+    This includes changes in the working tree and untracked files, but not
+    deleted files; renamed files are listed under their new name. Paths are
+    absolute.
+    """
+    root = toplevel(cwd)
+    out = _git(
+        "diff",
+        "--name-only",
+        "-z",
+        "--find-renames",
+        "--diff-filter=ACMR",
+        since,
+        "--",
+        cwd=root,
+    )
+    out += _git("ls-files", "-z", "--others", "--exclude-standard", cwd=root)
+    return {root / p for p in out.split("\0") if p}
+
+
+def ls_python_files(root):
+    """
+    Python files under the directory ``root`` that are tracked, or untracked
+    and not ignored, sorted.
+    """
+    out = _git(
+        "ls-files",
+        "-z",
+        "--cached",
+        "--others",
+        "--exclude-standard",
+        "--",
+        ".",
+        cwd=root,
+    )
+    names = sorted({name for name in out.split("\0") if name.endswith(".py")})
+    # tracked files may have been deleted.
+    return [root / name for name in names if (root / name).is_file()]
+
+
+_HUNK = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+def staged_line_ranges(cwd=None):
+    """
+    Lines changed in the staged version of the added, modified or renamed files.
+
+    Returns a mapping from absolute path to a list of ``(start, end)`` line
+    ranges (1-based, inclusive). Lines removed without replacement are
+    reported as a range covering the lines around them.
+    """
+    root = toplevel(cwd)
+    options = ["--cached", "--find-renames", "--diff-filter=ACMR"]
+    # names as is, the headers of the diff quote or end some of them with a tab,
+    # the files come in the same order in both.
+    out = _git("diff", *options, "--name-only", "-z", "--", cwd=root)
+    names = iter([name for name in out.split("\0") if name])
+    out = _git("diff", *options, "-U0", "--no-color", "--no-ext-diff", "--", cwd=root)
+    ranges = {}
+    current = None
+    for line in out.split("\n"):
+        if line.startswith("diff --git "):
+            current = ranges.setdefault(root / next(names), [])
+        elif (m := _HUNK.match(line)) and current is not None:
+            start = int(m.group(1))
+            count = 1 if m.group(2) is None else int(m.group(2))
+            if count:
+                current.append((start, start + count - 1))
+            else:
+                current.append((max(start, 1), start + 1))
+    return ranges
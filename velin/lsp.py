@@ -0,0 +1,391 @@
+"""
+Language server for vélin, ``velin lsp``.
+
+A minimal Language Server Protocol implementation over stdio, without
+dependencies. Open documents are kept in memory with the result of every
+docstring, keyed by the docstring and everything its reformatting depends on
+(see ``_memo_key``): on each change only the new or modified docstrings are
+reformatted. Results are published as diagnostics, with the reformatted
+docstrings as text edits (``textDocument/formatting`` and quick fixes).
+
+Positions are in UTF-16 code units as required by the protocol, ``ast`` gives
+UTF-8 byte offsets, and documents are stored as Python strings.
+"""
+
+import io
+import json
+import sys
+import traceback
+import warnings
+from bisect import bisect_right
+from contextlib import redirect_stdout
+
+from velin import __version__, ref
+from velin.cache import CACHES
+from velin.ref import (
+    Config,
+    _collect_docstrings,
+    _docstring_body,
+    _docstring_edit,
+    _LineOffsets,
+    _memo_key,
+    _reformat_docstring,
+    _watch_warnings,
+)
+
+# LSP DiagnosticSeverity
+ERROR = 1
+WARNING = 2
+INFORMATION = 3
+
+
+def read_message(stream):
+    """
+    Read one JSON-RPC message from a binary stream, None at the end of it.
+    """
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.decode("ascii").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    if length is None:
+        raise ValueError("missing Content-Length header")
+    return json.loads(stream.read(length))
+
+
+def write_message(stream, message):
+    body = json.dumps(message).encode()
+    stream.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    stream.flush()
+
+
+def _utf16_len(text):
+    return len(text) + sum(1 for c in text if ord(c) > 0xFFFF)
+
+
+def _from_utf16(line, character):
+    """
+    Index in ``line`` of a UTF-16 ``character`` offset.
+    """
+    units = 0
+    for i, c in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(c) > 0xFFFF else 1
+    return len(line)
+
+
+class Document:
+    """
+    An open document, and the results of its docstrings.
+    """
+
+    def __init__(self, uri, text, version=None):
+        self.uri = uri
+        self.version = version
+        self.text = text
+        # (memo key, qname) -> (new_doc, fail_check, messages)
+        self.results = {}
+        # last version of the text that could be parsed, and its docstrings
+        # as (record, result).
+        self.parsed = None
+        self.docstrings = []
+
+    @property
+    def filename(self):
+        from urllib.parse import unquote
+
+        return unquote(self.uri.rsplit("/", 1)[-1])
+
+    def offset(self, position):
+        starts = _LineOffsets(self.text).starts
+        line = position["line"]
+        if line >= len(starts):
+            return len(self.text)
+        start = starts[line]
+        end = starts[line + 1] if line + 1 < len(starts) else len(self.text)
+        return start + _from_utf16(self.text[start:end], position["character"])
+
+    def apply_change(self, change):
+        if "range" not in change:
+            self.text = change["text"]
+            return
+        start = self.offset(change["range"]["start"])
+        end = self.offset(change["range"]["end"])
+        self.text = self.text[:start] + change["text"] + self.text[end:]
+
+
+def _position(lines, offset):
+    """
+    LSP position of ``offset`` in the source indexed by ``lines``.
+    """
+    line = bisect_right(lines.starts, offset) - 1
+    start = lines.starts[line]
+    return {"line": line, "character": _utf16_len(lines.data[start:offset])}
+
+
+class Server:
+    """
+    Language server, dispatching the JSON-RPC messages to ``m_*`` methods.
+    """
+
+    def __init__(self, output, config, compact=False, unsafe=False):
+        self.output = output
+        self.config = config
+        self.compact = compact
+        self.unsafe = unsafe
+        self.documents = {}
+        self.shutdown = False
+
+    def send(self, message):
+        write_message(self.output, {"jsonrpc": "2.0", **message})
+
+    def notify(self, method, params):
+        self.send({"method": method, "params": params})
+
+    def handle(self, message):
+        method = message.get("method")
+        handler = getattr(self, "m_" + (method or "").replace("/", "_"), None)
+        if "id" not in message:
+            if handler is None:
+                return
+            # there is no response to report the error of a notification in,
+            # log it and keep serving.
+            try:
+                handler(message.get("params") or {})
+            except Exception:
+                print(f"velin lsp: error handling {method}", file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+            return
+        if handler is None:
+            self.send(
+                {
+                    "id": message["id"],
+                    "error": {"code": -32601, "message": f"{method} not supported"},
+                }
+            )
+            return
+        try:
+            result = handler(message.get("params") or {})
+        except Exception as e:
+            self.send(
+                {"id": message["id"], "error": {"code": -32603, "message": str(e)}}
+            )
+        else:
+            self.send({"id": message["id"], "result": result})
+
+    def m_initialize(self, params):
+        return {
+            "capabilities": {
+                # incremental
+                "textDocumentSync": {"openClose": True, "change": 2},
+                "documentFormattingProvider": True,
+                "codeActionProvider": {"codeActionKinds": ["quickfix"]},
+            },
+            "serverInfo": {"name": "velin", "version": __version__},
+        }
+
+    def m_initialized(self, params):
+        pass
+
+    def m_shutdown(self, params):
+        self.shutdown = True
+        return None
+
+    def m_exit(self, params):
+        raise SystemExit(0 if self.shutdown else 1)
+
+    def m_textDocument_didOpen(self, params):
+        item = params["textDocument"]
+        doc = Document(item["uri"], item["text"], item.get("version"))
+        self.documents[doc.uri] = doc
+        self.update(doc)
+
+    def m_textDocument_didChange(self, params):
+        doc = self.documents[params["textDocument"]["uri"]]
+        doc.version = params["textDocument"].get("version")
+        for change in params["contentChanges"]:
+            doc.apply_change(change)
+        self.update(doc)
+
+    def m_textDocument_didClose(self, params):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.notify("textDocument/publishDiagnostics", {"uri": uri, "diagnostics": []})
+
+    def m_textDocument_formatting(self, params):
+        doc = self.documents[params["textDocument"]["uri"]]
+        return [edit for _, _, edit in self.edits(doc)]
+
+    def m_textDocument_codeAction(self, params):
+        doc = self.documents[params["textDocument"]["uri"]]
+        start, end = params["range"]["start"], params["range"]["end"]
+        key = lambda p: (p["line"], p["character"])  # noqa: E731
+        actions = []
+        for record, diagnostic, edit in self.edits(doc):
+            if key(edit["range"]["end"]) < key(start):
+                continue
+            if key(edit["range"]["start"]) > key(end):
+                continue
+            actions.append(
+                {
+                    "title": f"Reformat docstring of {record.qname}",
+                    "kind": "quickfix",
+                    "diagnostics": [diagnostic],
+                    "edit": {"changes": {doc.uri: [edit]}},
+                }
+            )
+        return actions
+
+    def reformat(self, doc, record):
+        """
+        Reformat a docstring, capturing what would be printed as messages.
+        """
+        out = io.StringIO()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            with redirect_stdout(out), _watch_warnings():
+                new_doc, fail_check, _ = _reformat_docstring(
+                    record, doc.filename, self.compact, self.unsafe, False, self.config
+                )
+        messages = [str(w.message) for w in caught]
+        if text := out.getvalue().strip():
+            messages.insert(0, text)
+        return new_doc, fail_check, messages
+
+    def update(self, doc):
+        """
+        Reformat the new and modified docstrings of ``doc``, publish diagnostics.
+        """
+        try:
+            records = _collect_docstrings(doc.text, doc.filename, [])
+        except (SyntaxError, ValueError):
+            # keep the diagnostics of the last version that parsed, as the
+            # user is likely in the middle of typing.
+            return
+        results = {}
+        docstrings = []
+        for record in records:
+            key = (
+                _memo_key(record, self.compact, self.unsafe, self.config),
+                record.qname,
+            )
+            if key in doc.results:
+                results[key] = doc.results[key]
+            elif key not in results:
+                results[key] = self.reformat(doc, record)
+            docstrings.append((record, results[key]))
+        doc.results = results
+        doc.parsed = doc.text
+        doc.docstrings = docstrings
+        self.notify(
+            "textDocument/publishDiagnostics",
+            {
+                "uri": doc.uri,
+                "version": doc.version,
+                "diagnostics": [d for _, d, _ in self.diagnostics(doc)],
+            },
+        )
+
+    def diagnostics(self, doc):
+        """
+        (record, diagnostic, edit or None) for the docstrings needing attention.
+
+        Edits are only given if the document did not change since it was last
+        parsed.
+        """
+        data = doc.parsed
+        lines = _LineOffsets(data)
+        for record, (new_doc, fail_check, messages) in doc.docstrings:
+            changed = new_doc is not None and new_doc != record.docstring
+            if not (changed or messages or fail_check):
+                continue
+            body = _docstring_body(data, lines, record)
+            if body is None:
+                line = {"line": record.lineno - 1, "character": 0}
+                range_ = {"start": line, "end": line}
+            else:
+                range_ = {
+                    "start": _position(lines, body[0]),
+                    "end": _position(lines, body[1]),
+                }
+            edit = None
+            if changed and doc.text == data:
+                span = _docstring_edit(data, lines, record, new_doc)
+                if span is not None:
+                    edit = {
+                        "range": {
+                            "start": _position(lines, span.start),
+                            "end": _position(lines, span.end),
+                        },
+                        "newText": span.text,
+                    }
+            if new_doc is None:
+                severity, message = ERROR, "vélin could not reformat this docstring"
+            else:
+                severity, message = WARNING, "Docstring can be reformatted"
+            if messages:
+                message = "\n".join(messages)
+            diagnostic = {
+                "range": range_,
+                "severity": severity if changed or new_doc is None else INFORMATION,
+                "source": "velin",
+                "message": message,
+            }
+            yield record, diagnostic, edit
+
+    def edits(self, doc):
+        return [item for item in self.diagnostics(doc) if item[2] is not None]
+
+
+def serve(input, output, config, compact=False, unsafe=False):
+    server = Server(output, config, compact=compact, unsafe=unsafe)
+    while (message := read_message(input)) is not None:
+        try:
+            server.handle(message)
+        except SystemExit as e:
+            return e.code
+    return 0 if server.shutdown else 1
+
+
+def serve_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="velin lsp",
+        description="Language server reformatting docstrings, over stdio.",
+    )
+    parser.add_argument("--black", action="store_true", dest="run_black")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--unsafe", action="store_true")
+    parser.add_argument("--no-fixers", action="store_false", dest="run_fixers")
+    args = parser.parse_args(argv)
+    ref.BLACK_REFORMAT = args.run_black
+    config = Config(
+        {
+            "with_placeholder": False,
+            "compact_param": args.compact,
+            "space_in_see_also_title": False,
+            "space_in_notes_title": False,
+            "run_fixers": args.run_fixers,
+        }
+    )
+    for memo in CACHES.values():
+        memo.load()
+    # stdout is the protocol channel, anything else printed goes to stderr.
+    output = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    try:
+        code = serve(
+            sys.stdin.buffer, output, config, compact=args.compact, unsafe=args.unsafe
+        )
+    finally:
+        for memo in CACHES.values():
+            memo.dump()
+    sys.exit(code)
@@ -1,16 +1,38 @@
 import argparse
 import ast
-import difflib
+import hashlib
+import io
+import os
 import re
 import sys
+import warnings
+from collections import namedtuple
 from configparser import ConfigParser
+from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
 from textwrap import indent
 
 import numpydoc.docscrape as nds
 from numpydoc.docscrape import Parameter
 
-from velin.examples_section_utils import reformat_example_lines
+from velin.cache import (
+    CACHES,
+    STATS,
+    Cache,
+    LRUCache,
+    file_key,
+    hit_rate,
+    merge_worker_state,
+    worker_state,
+)
+from velin.diff import DiffPrinter, unified_diff
+from velin.examples_section_utils import (
+    example_code_blocks,
+    reformat_batch,
+    reformat_example_lines,
+)
+from velin.files import SourceWriter, read_file
+from velin.walk import python_files
 
 
 def f(a, b, *args, **kwargs):
@@ -60,92 +82,76 @@ def g(a, b):
     """
 
 
-class NodeVisitor(ast.NodeVisitor):
+class NodeVisitor:
+    """
+    Find the functions of a module, and their qualified names.
+
+    Only the bodies of statements are walked, as functions and classes can't be
+    defined in expressions.
+    """
+
+    # fields of statements (and except handlers, match cases) holding statements.
+    _bodies = ("body", "handlers", "orelse", "finalbody", "cases")
+
     def __init__(self, config):
         self.config = config
+        self.skip = frozenset(config["skip"] or ())
         self.items = []
+        # qualified names of the enclosing classes and functions.
         self.stack = []
 
     def visit(self, node):
-        if type(node) in (ast.ClassDef, ast.FunctionDef):
-            self.stack.append(node.name)
-            # print(self.stack)
-            oname = ".".join(self.stack)
-            if oname in self.config["skip"]:
-                print("SKIPPING", oname)
+        self.items.extend(self.functions(node))
+
+    def functions(self, node):
+        """
+        Generate ``(node, meta, qname)`` for the functions in ``node``.
+
+        Functions are generated in source order, before the functions they
+        contain. Objects in ``config["skip"]`` and their content are skipped.
+        """
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            oname = f"{self.stack[-1]}.{node.name}" if self.stack else node.name
+            self.stack.append(oname)
+            try:
+                if oname in self.skip:
+                    print("SKIPPING", oname)
+                    return
+                if not isinstance(node, ast.ClassDef):
+                    yield node, _function_meta(node), oname
+                yield from self._children(node)
+            finally:
                 self.stack.pop()
-                return
-            super().visit(node)
-            self.stack.pop()
-        elif type(node) in (
-            ast.Load,
-            ast.Name,
-            ast.Call,
-            ast.Compare,
-            ast.Attribute,
-            ast.Expr,
-            ast.arguments,
-            ast.Import,
-            ast.alias,
-            ast.Constant,
-            ast.Store,
-            ast.Assign,
-            ast.arg,
-        ):
-            super().visit(node)
         else:
-            # print(type(node))
-            super().visit(node)
-
-    def visit_FunctionDef(self, node):
-        # we can collect function args, and _could_ check the Parameter section.
-        # for nn in node.args.args:
-        #    nnn = nn.arg
-        # for k in [l for l in dir(node) if not l.startswith('_')]:
-        #    sub = getattr(node, k)
-        #    print(k, sub)
-        #    for u in [l for l in dir(sub) if not l.startswith('_')]:
-        #        ss = getattr(sub, u)
-        #        print('    ', u, ss)
-
-        # node.args.kwarg # single object
-        # node.args.vararg # object
-        # node.args.ks_defaults #list
-        # print(node.returns)
-        # node.args.defaults +
-
-        meta = {
-            "simple": [
-                arg
-                for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs
-            ],
-            "varargs": None,
-            "varkwargs": None,
-        }
-        if node.args.kwarg:
-            meta["varkwargs"] = node.args.kwarg
-            dir(node.args.kwarg)
-        if node.args.vararg:
-            meta["varargs"] = node.args.vararg
-        # print(arg.arg)
-        #    for k in [l for l in dir(arg) if not l.startswith('_')]:
-        #        sub = getattr(arg, k)
-        #        print('    ', k, sub)
+            yield from self._children(node)
 
-        self.items.append((node, meta, ".".join(self.stack)))
-        self.generic_visit(node)
+    def _children(self, node):
+        for field in self._bodies:
+            for child in getattr(node, field, None) or ():
+                yield from self.functions(child)
 
-    def visit_ClassDef(self, node):
-        # we can collect function args, and _could_ check the Parameter section.
-        # for nn in node.args.args:
-        #    nnn = nn.arg
 
-        # self.items.append((node, None))
-        self.generic_visit(node)
+def _function_meta(node):
+    """
+    Arguments of a function, to check its Parameters section against.
+    """
+    args = node.args
+    return {
+        "simple": args.posonlyargs + args.args + args.kwonlyargs,
+        "varargs": args.vararg,
+        "varkwargs": args.kwarg,
+    }
 
 
 BLACK_REFORMAT = True
 
+# reformatted docstrings, see _reformat_docstring
+DOC_MEMO = LRUCache("docstrings", maxsize=50_000)
+
+# with --jobs, files bigger than this (in bytes) have their docstrings split
+# across workers.
+SPLIT_FILE_SIZE = 256 * 1024
+
 
 class NumpyDocString(nds.NumpyDocString):
     """
@@ -324,17 +330,42 @@ class Config:
         self._conf = conf
 
     def __getattr__(self, key):
-        if key in self._conf:
-            return self._conf[key]
+        # look up _conf in __dict__ so that unpickling (in worker processes)
+        # does not recurse before _conf is restored.
+        conf = self.__dict__.get("_conf", {})
+        if key in conf:
+            return conf[key]
         else:
             return getattr(type(self), "_" + key)
 
 
+# characters other than "\n" that str.splitlines() breaks lines on.
+_LINE_BREAKS = re.compile("[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+def _indent_lines(lines, prefix):
+    """
+    Lines of ``textwrap.indent("\\n".join(lines), prefix)``.
+    """
+    text = "\n".join(lines)
+    if _LINE_BREAKS.search(text):
+        return indent(text, prefix).split("\n")
+    return [prefix + line if line.strip() else line for line in text.split("\n")]
+
+
+def _text(lines):
+    return "".join(line + "\n" for line in lines)
+
+
 class SectionFormatter:
     """
     Render section of the docs, based on some configuration. Not having
     configuration is great, but everybody has their pet peevs, and I'm hpping we
     can progressively convince them to adopt a standard.
+
+    Each ``write_<Section>`` method appends the lines of a section to ``out``, a
+    list shared by all the sections of a docstring. Layout choices are made
+    before writing, so that each section is written once.
     """
 
     def __init__(self, *, conf):
@@ -342,162 +373,151 @@ class SectionFormatter:
         self.config = conf
 
     @classmethod
-    def format_Signature(self, s, compact):
-        return s + "\n"
+    def write_Signature(cls, out, s, compact):
+        out.append(s)
 
     @classmethod
-    def format_Summary(self, s, compact):
+    def write_Summary(cls, out, s, compact):
         if len(s) == 1 and not s[0].strip():
-            return ""
-        return "\n".join(s) + "\n"
+            return
+        out.extend(s)
 
     @classmethod
-    def format_Extended_Summary(self, es, compact):
-        return "\n".join(es) + "\n"
-
-    def _format_ps(self, name, ps, compact):
-        res, try_other = self._format_ps_pref(name, ps, compact=True)
-        if not try_other or self.config.compact_param:
-            return res
-        return self._format_ps_pref(name, ps, compact=False)[0]
+    def write_Extended_Summary(cls, out, es, compact):
+        out.extend(es)
 
-    def _format_ps_pref(self, name, ps, *, compact):
-        try_other = False
-        out = name + "\n"
-        out += "-" * len(name) + "\n"
+    def _write_ps(self, out, name, ps):
+        # entries are separated by blank lines only if a description has some.
+        compact = self.config.compact_param or not any(
+            not line.strip() for p in ps if p.desc for line in p.desc
+        )
+        out.append(name)
+        out.append("-" * len(name))
         for i, p in enumerate(ps):
             if (not compact) and i:
-                out += "\n"
+                out.append("")
             if p.type:
-                out += f"""{p.name.strip()} : {p.type.strip()}\n"""
+                out.append(f"{p.name.strip()} : {p.type.strip()}")
             else:
-                out += f"""{p.name.strip()}\n"""
+                out.append(p.name.strip())
             if p.desc:
-                if any([line.strip() == "" for line in p.desc]):
-                    try_other = True
-
-                out += indent("\n".join(p.desc), "    ")
-                out += "\n"
-        return out, try_other
-
-    def format_Parameters(self, ps, compact):
-        return self._format_ps("Parameters", ps, compact)
+                out.extend(_indent_lines(p.desc, "    "))
 
-    def format_Methods(self, ps, compact):
-        return self._format_ps("Methods", ps, compact)
-
-    def format_Other_Parameters(self, ps, compact):
-        return self._format_ps("Other Parameters", ps, compact)
+    def write_Parameters(self, out, ps, compact):
+        self._write_ps(out, "Parameters", ps)
 
-    def format_See_Also(self, sas, compact):
+    def write_Methods(self, out, ps, compact):
+        self._write_ps(out, "Methods", ps)
 
-        res = self.format_See_Also_impl(sas, True, force_compact=compact)
-        if res is not None:
-            return res
-        return self.format_See_Also_impl(sas, False, force_compact=compact)
+    def write_Other_Parameters(self, out, ps, compact):
+        self._write_ps(out, "Other Parameters", ps)
 
-    def format_See_Also_impl(self, sas, compact, force_compact, *varargs, **varkwargs):
+    def _see_also_fits(self, entries):
         """
-        Format a see also section.
+        Whether the descriptions of single references fit on the line of the
+        reference, within 80 columns.
+        """
+        # last line written so far, as the width is measured from there.
+        last = "" if self.config.space_in_see_also_title else "--------"
+        for a, refs, b in entries:
+            line = refs
+            if b and b[0]:
+                if len(a) > 1:
+                    line = "    " + b[0]
+                else:
+                    current = refs.splitlines()[-1] if refs else last
+                    if len(current) + 3 + len(b[0]) > 80:
+                        return False
+                    line = refs + " : " + b[0]
+            if len(b) > 1:
+                line = "    " + b[-1]
+            last = (line + "\n").splitlines()[-1]
+        return True
 
+    def write_See_Also(self, out, sas, compact):
+        """
+        Write a see also section.
 
+        With ``compact``, or if they all fit, descriptions of single references
+        are on the same line as the reference.
         """
-        out = "See Also\n"
-        out += "--------\n"
+        entries = [
+            (
+                a,
+                ", ".join(
+                    f":{type_}:`{ref}`" if type_ is not None else f"{ref}"
+                    for ref, type_ in a
+                ),
+                b,
+            )
+            for a, b in sas
+        ]
+        one_line = compact or self._see_also_fits(entries)
+        out.append("See Also")
+        out.append("--------")
         if self.config.space_in_see_also_title:
-            out += "\n"
-
-        for a, b in sas:
-            if b:
-                desc = b[0]
-            else:
-                desc = None
-            if len(b) > 1:
-                rest_desc = b[1:]
-            else:
-                rest_desc = []
-            _first = True
-            for ref, type_ in a:
-                # if len(a) > 1:
-                #    assert type_ is None, a # matplotlib mlab cohere
-                if not _first:
-                    out += ", "
-                if type_ is not None:
-                    out += f":{type_}:`{ref}`"
-                else:
-                    out += f"{ref}"
-                _first = False
-
+            out.append("")
+        for a, refs, b in entries:
+            desc = b[0] if b else None
             if desc:
-                if len(a) > 1 or (not compact):
-                    out += f" :\n    {desc}"
+                if len(a) > 1 or not one_line:
+                    out.append(refs + " :")
+                    out.append("    " + desc)
                 else:
-                    attempt = f" : {desc}"
-                    if len(out.splitlines()[-1] + attempt) > 80 and not force_compact:
-                        return None
-                    out += attempt
-            for rd in rest_desc:
-                out += "\n    " + rd
-            out += "\n"
-        return out
+                    out.append(f"{refs} : {desc}")
+            else:
+                out.append(refs)
+            out.extend("    " + rd for rd in b[1:])
 
     @classmethod
-    def format_References(cls, lines, compact):
-        out = "References\n"
-        out += "----------\n"
-        out += "\n".join(lines)
-        out += "\n"
-        return out
-
-    def format_Notes(self, lines, compact):
-        out = "Notes\n"
-        out += "-----\n"
+    def write_References(cls, out, lines, compact):
+        out.append("References")
+        out.append("----------")
+        out.extend(lines)
+
+    def write_Notes(self, out, lines, compact):
+        out.append("Notes")
+        out.append("-----")
         if self.config.space_in_notes_title:
-            out += "\n"
-        out += "\n".join(lines)
-        out += "\n"
-        return out
+            out.append("")
+        out.extend(lines)
 
     @classmethod
-    def format_Examples(cls, lines, compact):
-        out = "Examples\n"
-        out += "--------\n"
-        out += "\n".join(lines)
-        out += "\n"
-        return out
+    def write_Examples(cls, out, lines, compact):
+        out.append("Examples")
+        out.append("--------")
+        out.extend(lines)
 
     @classmethod
-    def format_Warnings(cls, lines, compact):
-        out = "Warnings\n"
-        out += "--------\n"
-        out += "\n".join(lines)
-        out += "\n"
-        return out
+    def write_Warnings(cls, out, lines, compact):
+        out.append("Warnings")
+        out.append("--------")
+        out.extend(lines)
 
     @classmethod
-    def format_Warns(cls, ps, compact):
-        return cls.format_RRY("Warns", ps)
+    def write_Warns(cls, out, ps, compact):
+        cls.write_RRY(out, "Warns", ps)
 
     @classmethod
-    def format_Raises(cls, ps, compact):
-        return cls.format_RRY("Raises", ps)
+    def write_Raises(cls, out, ps, compact):
+        cls.write_RRY(out, "Raises", ps)
 
     @classmethod
-    def format_Yields(cls, ps, compact):
-        return cls.format_RRY("Yields", ps)
+    def write_Yields(cls, out, ps, compact):
+        cls.write_RRY(out, "Yields", ps)
 
     @classmethod
-    def format_Returns(cls, ps, compact):
-        return cls.format_RRY("Returns", ps)
+    def write_Returns(cls, out, ps, compact):
+        cls.write_RRY(out, "Returns", ps)
 
     @classmethod
-    def format_Attributes(cls, ps, compact):
-        return cls.format_RRY("Attributes", ps)
+    def write_Attributes(cls, out, ps, compact):
+        cls.write_RRY(out, "Attributes", ps)
 
     @classmethod
-    def format_RRY(cls, name, ps):
-        out = name + "\n"
-        out += "-" * len(name) + "\n"
+    def write_RRY(cls, out, name, ps):
+        out.append(name)
+        out.append("-" * len(name))
 
         if name == "Returns":
             if len(ps) > 1:
@@ -512,15 +532,124 @@ class SectionFormatter:
                     "Warning numpydoc may have misparsed this section.", p.name, p.type
                 )
             if p.name and p.type:
-                out += f"""{p.name.strip()} : {p.type.strip()}\n"""
+                out.append(f"{p.name.strip()} : {p.type.strip()}")
             elif p.name:
-                out += f"""{p.name.strip()}\n"""
+                out.append(p.name.strip())
             else:
-                out += f"""{p.type.strip()}\n"""
+                out.append(p.type.strip())
             if p.desc:
-                out += indent("\n".join(p.desc), "    ")
-                out += "\n"
-        return out
+                out.extend(_indent_lines(p.desc, "    "))
+
+    def write(self, out, section, value, compact):
+        """
+        Write ``section``, separated by a blank line from the previous ones.
+        """
+        if out:
+            out.append("")
+        n = len(out)
+        getattr(self, "write_" + section.replace(" ", "_"))(out, value, compact)
+        if n == len(out) and n:
+            # nothing written, no separator either.
+            out.pop()
+
+    # format_* return the text of a section, as before the write_* methods.
+
+    @classmethod
+    def format_Signature(cls, s, compact):
+        out = []
+        cls.write_Signature(out, s, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Summary(cls, s, compact):
+        out = []
+        cls.write_Summary(out, s, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Extended_Summary(cls, es, compact):
+        out = []
+        cls.write_Extended_Summary(out, es, compact)
+        return _text(out)
+
+    def format_Parameters(self, ps, compact):
+        out = []
+        self.write_Parameters(out, ps, compact)
+        return _text(out)
+
+    def format_Methods(self, ps, compact):
+        out = []
+        self.write_Methods(out, ps, compact)
+        return _text(out)
+
+    def format_Other_Parameters(self, ps, compact):
+        out = []
+        self.write_Other_Parameters(out, ps, compact)
+        return _text(out)
+
+    def format_See_Also(self, sas, compact):
+        out = []
+        self.write_See_Also(out, sas, compact)
+        return _text(out)
+
+    @classmethod
+    def format_References(cls, lines, compact):
+        out = []
+        cls.write_References(out, lines, compact)
+        return _text(out)
+
+    def format_Notes(self, lines, compact):
+        out = []
+        self.write_Notes(out, lines, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Examples(cls, lines, compact):
+        out = []
+        cls.write_Examples(out, lines, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Warnings(cls, lines, compact):
+        out = []
+        cls.write_Warnings(out, lines, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Warns(cls, ps, compact):
+        out = []
+        cls.write_Warns(out, ps, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Raises(cls, ps, compact):
+        out = []
+        cls.write_Raises(out, ps, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Yields(cls, ps, compact):
+        out = []
+        cls.write_Yields(out, ps, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Returns(cls, ps, compact):
+        out = []
+        cls.write_Returns(out, ps, compact)
+        return _text(out)
+
+    @classmethod
+    def format_Attributes(cls, ps, compact):
+        out = []
+        cls.write_Attributes(out, ps, compact)
+        return _text(out)
+
+    @classmethod
+    def format_RRY(cls, name, ps):
+        out = []
+        cls.write_RRY(out, name, ps)
+        return _text(out)
 
 
 def dedend_docstring(docstring):
@@ -537,6 +666,29 @@ def dedend_docstring(docstring):
     return "\n".join(docstring)
 
 
+# ``(kind, message)`` of the issues found by `parameter_fixer`, while
+# `_collect_issues` is active.
+_ISSUES = None
+
+
+def _report_issue(kind, message):
+    if _ISSUES is not None:
+        _ISSUES.append((kind, message))
+
+
+@contextmanager
+def _collect_issues():
+    """
+    Collect the parameter issues reported while reformatting a docstring.
+    """
+    global _ISSUES
+    outer, _ISSUES = _ISSUES, []
+    try:
+        yield _ISSUES
+    finally:
+        _ISSUES = outer
+
+
 def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
     assert "Parameters" in doc
     incorrect_number = False
@@ -575,7 +727,10 @@ def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
             if n_star_missing:
                 correct = list(n_star_missing)[0]
                 incorrect = correct[len(stars) :]
-                rename_param(incorrect, correct)
+                if rename_param(incorrect, correct):
+                    _report_issue(
+                        "renamed-parameter", f"renamed {incorrect!r} to {correct!r}"
+                    )
                 doc_missing.remove(correct)
                 doc_extra.remove(incorrect)
         for param in list(doc_extra):
@@ -587,6 +742,7 @@ def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
                 correct = param[1:-1]
                 rename_param(param, correct)
                 print("unquote", param, "to", correct)
+                _report_issue("renamed-parameter", f"renamed {param!r} to {correct!r}")
                 doc_missing.remove(correct)
                 doc_extra.remove(param)
 
@@ -603,14 +759,18 @@ def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
                 if rename_param(incorrect, correct):
                     print(f"{fname}:{func_name}")
                     print(f"    renamed {incorrect!r} to {correct!r}")
+                    _report_issue(
+                        "renamed-parameter", f"renamed {incorrect!r} to {correct!r}"
+                    )
                     doc_missing = {}
                     doc_extra = {}
                 else:
                     print("  could not fix:", doc_missing, doc_extra)
     if doc_missing and not doc_extra and config.with_placeholder:
-        for param in doc_missing:
+        for param in sorted(doc_missing):
             if "*" in param:
                 continue
+            _report_issue("missing-parameter", f"added a placeholder for {param!r}")
             annotation_str = "<Insert Type here>"
             current_param = [m for m in meta["simple"] if m.arg == param]
             assert len(current_param) == 1, (current_param, meta, param)
@@ -639,6 +799,7 @@ def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
             print(
                 f"    removing parameters {remove_me!r}",
             )
+            _report_issue("extra-parameter", f"removed {remove_me.name!r}")
             params.remove(remove_me)
     elif doc_missing or doc_extra:
         incorrect_number = True
@@ -647,6 +808,10 @@ def parameter_fixer(params, meta_arg, meta, fname, func_name, config, doc):
             print("  missing:", doc_missing)
         if doc_extra:
             print("  extra:", doc_extra)
+        for param in sorted(doc_missing):
+            _report_issue("missing-parameter", f"{param!r} is not documented")
+        for param in sorted(doc_extra):
+            _report_issue("extra-parameter", f"{param!r} is not a parameter")
 
     return params, jump_to_location, incorrect_number
 
@@ -725,21 +890,13 @@ def compute_new_doc(docstr, fname, *, level, compact, meta, func_name, config):
         if incorrect_number:
             fail_check = True
 
-    fmt = ""
-    start = True
+    lines = []
     # ordered_section is a local patch to that records the docstring order.
     df = SectionFormatter(conf=config)
     for s in getattr(doc, "ordered_sections", doc.sections):
         if doc[s]:
-            f = getattr(df, "format_" + s.replace(" ", "_"))
-            res = f(doc[s], compact)
-            if not res:
-                continue
-            if not start:
-                fmt += "\n"
-            start = False
-            fmt += res
-    fmt = indent(fmt, INDENT) + INDENT
+            df.write(lines, s, doc[s], compact)
+    fmt = "\n".join(_indent_lines(lines, INDENT) + [INDENT]) if lines else INDENT
 
     # hack to detect if we have seen a header section.
     if "----" in fmt or True:
@@ -786,8 +943,561 @@ def reformat_file(data, filename, compact, unsafe, fail=False, config=None, obj_
     )[0]
 
 
+DocstringRecord = namedtuple(
+    "DocstringRecord",
+    [
+        "docstring",
+        "func_name",
+        "qname",
+        "meta",
+        "lineno",
+        "col_offset",
+        "end_lineno",
+        "end_col_offset",
+    ],
+)
+
+
+# A string literal starting a block: on the line after a colon (and blank or
+# comment lines), or on the same line as a signature.
+_BLOCK_STRING = re.compile(
+    r"""
+    (?:
+        :[ \t\f]*(?:\#[^\n]*)?\r?\n
+        (?:[ \t\f]*(?:\#[^\n]*)?\r?\n)*
+        [ \t\f]+
+      |
+        \)[ \t\f]*(?:->[^\n]*?)?:[ \t\f]*(?:\\\r?\n[ \t\f]*)*
+    )
+    [rRuUbBfF]{0,2}(\"\"\"|'''|"|')
+    """,
+    re.VERBOSE,
+)
+
+
+def _may_have_docstrings(data):
+    """
+    Whether the source ``data`` may contain function docstrings to reformat.
+
+    A lexical scan, much cheaper than ``ast.parse``: it only rules out files
+    without ``def``, or whose block-starting strings are all single-line and
+    not blank, which ``compute_new_doc`` leaves untouched. It errs on the side
+    of returning True.
+    """
+    if "def" not in data:
+        return False
+    for m in _BLOCK_STRING.finditer(data):
+        if data[m.start()] == ":":
+            line = data[data.rfind("\n", 0, m.start()) + 1 : m.start()]
+            if line.lstrip().startswith("class "):
+                continue
+        quote = m.group(1)
+        end = data.find("\n", m.end())
+        rest = data[m.end() : end if end != -1 else len(data)]
+        close = rest.find(quote)
+        if close == -1:
+            return True
+        content, after = rest[:close], rest[close + len(quote) :].strip()
+        if "\\" in content or len(content.splitlines()) != 1 or not content.strip():
+            return True
+        if after and not after.startswith("#"):
+            return True
+    return False
+
+
+def _collect_docstrings(data, filename, obj_p, line_ranges=None):
+    """
+    Parse a file and return the list of function docstrings to reformat.
+
+    If ``line_ranges`` is given, only the docstrings overlapping one of those
+    ``(start, end)`` line ranges (1-based, inclusive) are returned.
+    """
+    return list(_iter_docstrings(data, filename, obj_p, line_ranges))
+
+
+def _iter_docstrings(data, filename, obj_p, line_ranges=None):
+    """
+    Generate the docstrings of ``_collect_docstrings`` as the file is walked.
+
+    Top level statements are released once their functions are found, so the
+    syntax tree does not outlive the walk.
+    """
+    if not obj_p and not _may_have_docstrings(data):
+        STATS["parse_skipped"] += 1
+        return
+    body = ast.parse(data, filename).body
+    visitor = NodeVisitor({"skip": obj_p})
+    for i, stmt in enumerate(body):
+        body[i] = None
+        for func, meta, qname in visitor.functions(stmt):
+            e0 = func.body[0]
+            if not (
+                isinstance(e0, ast.Expr)
+                and isinstance(e0.value, ast.Constant)
+                and isinstance(e0.value.value, str)
+            ):
+                continue
+            if line_ranges is not None and not any(
+                start <= e0.end_lineno and e0.lineno <= end
+                for start, end in line_ranges
+            ):
+                continue
+            yield DocstringRecord(
+                e0.value.value,
+                func.name,
+                qname,
+                meta,
+                e0.lineno,
+                e0.col_offset,
+                e0.end_lineno,
+                e0.end_col_offset,
+            )
+
+
+def _memo_key(record, compact, unsafe, config):
+    """
+    Key of a docstring in ``DOC_MEMO``.
+
+    Everything ``compute_new_doc`` depends on, except the file and function
+    names which are only used in messages.
+    """
+    meta = record.meta
+    simple = tuple(
+        (m.arg, m.annotation.id if type(m.annotation).__name__ == "Name" else None)
+        for m in meta["simple"]
+    )
+    varargs = meta["varargs"].arg if meta["varargs"] else None
+    varkwargs = meta["varkwargs"].arg if meta["varkwargs"] else None
+    key = (
+        record.docstring,
+        record.col_offset,
+        simple,
+        varargs,
+        varkwargs,
+        compact,
+        unsafe,
+        BLACK_REFORMAT,
+        sorted(config._conf.items()),
+    )
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+def _reformat_docstring(record, filename, compact, unsafe, fail, config):
+    """
+    Reformat a single docstring found by ``_collect_docstrings``.
+
+    Results are memoized in ``DOC_MEMO``, as long as reformatting did not print
+    anything, report issues or fail, so that identical docstrings are only
+    reformatted once.
+
+    Returns
+    -------
+    new_doc : str or None
+        The new docstring, None if something went wrong.
+    fail_check : bool
+        Whether this docstring should fail under the --check flag
+    issues : tuple of (str, str)
+        kind and message of the parameter issues found, see `Finding`.
+    """
+    key = _memo_key(record, compact, unsafe, config)
+    if (res := DOC_MEMO.get(key)) is not None:
+        return (*res, ())
+    out = io.StringIO()
+    try:
+        with redirect_stdout(out), _watch_warnings() as shown:
+            with _collect_issues() as issues:
+                res = _reformat_docstring_impl(
+                    record, filename, compact, unsafe, fail, config
+                )
+    finally:
+        sys.stdout.write(out.getvalue())
+    if not out.getvalue() and not shown and not issues and res[0] is not None:
+        DOC_MEMO.put(key, res)
+    return (*res, tuple(issues))
+
+
+@contextmanager
+def _watch_warnings():
+    """
+    Record the warnings that are shown, while still showing them.
+
+    They are also counted in ``STATS``, so that files that showed warnings
+    are not added to the cache.
+    """
+    shown = []
+    showwarning = warnings.showwarning
+
+    def _showwarning(message, *args, **kwargs):
+        if not shown:
+            STATS["warned"] += 1
+        shown.append(message)
+        return showwarning(message, *args, **kwargs)
+
+    warnings.showwarning = _showwarning
+    try:
+        yield shown
+    finally:
+        warnings.showwarning = showwarning
+
+
+def _fingerprint(doc):
+    """
+    Structure of a parsed docstring, to compare parses of different formattings.
+
+    Empty sections are dropped, and trailing whitespace and blank lines ignored.
+    """
+
+    def lines(value):
+        value = [line.rstrip() for line in value]
+        while value and not value[-1]:
+            value.pop()
+        return tuple(value)
+
+    res = {}
+    for section, value in doc._parsed_data.items():
+        if not value:
+            continue
+        if isinstance(value, str):
+            value = value.rstrip()
+        elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = lines(value)
+        elif isinstance(value, list) and all(isinstance(v, Parameter) for v in value):
+            value = tuple((p.name, p.type, lines(p.desc)) for p in value)
+        else:
+            value = repr(value)
+        if value:
+            res[section] = value
+    return res
+
+
+def _check_reparse(new_doc, doc, filename, qname, config):
+    """
+    Check that the reformatted docstring parses to the same structure as ``doc``.
+
+    ``doc`` is the (fixed) parse of the original docstring returned by
+    ``compute_new_doc``; the new docstring is parsed once and both are
+    compared with `_fingerprint`.
+    """
+    expected = _fingerprint(doc)
+    try:
+        new = NumpyDocString(dedend_docstring(new_doc))
+        if config.run_fixers:
+            new.normalize()
+        actual = _fingerprint(new)
+    except Exception as e:
+        actual = {"error": repr(e)}
+    if actual != expected:
+        secs1 = {k: v for k, v in actual.items() if v != expected.get(k)}
+        secs2 = {k: v for k, v in expected.items() if v != actual.get(k)}
+        raise ValueError(
+            "Numpydoc parsing seem to differ after reformatting, this may be a reformatting bug. Rerun with `velin --unsafe "
+            + str(filename)
+            + ":"
+            + qname
+            + "`\n"
+            + str(secs1)
+            + "\n"
+            + str(secs2),
+        )
+
+
+def _reformat_docstring_impl(record, filename, compact, unsafe, fail, config):
+    fail_check = False
+    docstring, func_name, qname, meta, start, nindent = record[:6]
+    # if not docstring in data:
+    #    print(f"skip {file}: {func.name}, can't do replacement yet")
+    try:
+        new_doc, d_, jump_to_loc, _fail_check = compute_new_doc(
+            docstring,
+            filename,
+            level=nindent,
+            compact=compact,
+            meta=meta,
+            func_name=func_name,
+            config=config,
+        )
+        if _fail_check:
+            fail_check = True
+        if jump_to_loc:
+            print("mvim", f"+{start}", filename)
+            pass
+            # call editor with file and line number
+        elif not unsafe and new_doc:
+            _check_reparse(new_doc, d_, filename, qname, config)
+    except Exception as e:
+        print(f"something went wrong with {filename}:{qname} :\n\n{docstring}")
+        if fail:
+            raise
+        else:
+            print(e)
+        return None, fail_check
+    if not docstring.strip():
+        print("DOCSTRING IS EMPTY !!!", func_name)
+    return new_doc, fail_check
+
+
+def _batch_examples(records, compact, unsafe, config):
+    """
+    Format the code of the Examples sections of ``records`` with one black call.
+
+    This only fills the black cache, docstrings already in ``DOC_MEMO`` are
+    skipped as they won't need black.
+    """
+    if not BLACK_REFORMAT:
+        return
+    texts = []
+    for record in records:
+        if _memo_key(record, compact, unsafe, config) in DOC_MEMO:
+            continue
+        if "xample" not in record.docstring:
+            continue
+        lines = dedend_docstring(record.docstring).split("\n")
+        texts.extend(example_code_blocks(lines))
+    if texts:
+        reformat_batch(texts)
+
+
+def _reformat_docstrings_captured(records, filename, compact, unsafe, fail, config):
+    """
+    Worker side of the docstring level parallelism, see ``_format_file_captured``.
+    """
+    out = io.StringIO()
+    results, exc = [], None
+    with redirect_stdout(out):
+        try:
+            _batch_examples(records, compact, unsafe, config)
+            for record in records:
+                results.append(
+                    _reformat_docstring(record, filename, compact, unsafe, fail, config)
+                )
+        except Exception as e:
+            exc = e
+    return results, out.getvalue(), exc
+
+
+# A replacement of ``data[start:end]`` by ``text``, see `docstring_edits`.
+Edit = namedtuple("Edit", ["start", "end", "text"])
+
+# A docstring failing --check: its qualified name, the span of the source it
+# covers, the ``(kind, message)`` of its issues and the `Edit` fixing it, if
+# any. Kinds are "reformat", "missing-parameter", "extra-parameter" and
+# "renamed-parameter".
+Finding = namedtuple("Finding", ["qname", "start", "end", "issues", "edit"])
+
+_NEWLINE = re.compile(r"\r\n?|\n")
+_LITERAL_START = re.compile(r"([rRuU]?)('''|\"\"\"|'|\")")
+
+
+class _LineOffsets:
+    """
+    Convert ``ast`` positions (line number, UTF-8 byte column) to offsets in
+    the source string.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.starts = [0] + [m.end() for m in _NEWLINE.finditer(data)]
+
+    def offset(self, lineno, col_offset):
+        start = self.starts[lineno - 1]
+        line = self.data[start : start + col_offset]
+        if not line.isascii():
+            line = line.encode()[:col_offset].decode()
+        return start + len(line)
+
+
+def _docstring_body(data, lines, record):
+    """
+    Span of the content of the docstring literal of ``record``, between quotes.
+
+    Returns ``(start, end, quote, escaped)``, with ``escaped`` True if the
+    backslashes of the docstring are doubled in the source. None if the source
+    does not simply spell the docstring (implicit concatenation, parentheses,
+    other escape sequences...), those can't be edited.
+    """
+    start = lines.offset(record.lineno, record.col_offset)
+    end = lines.offset(record.end_lineno, record.end_col_offset)
+    m = _LITERAL_START.match(data, start, end)
+    if m is None:
+        return None
+    prefix, quote = m.groups()
+    start, end = m.end(), end - len(quote)
+    if end < start or data[end : end + len(quote)] != quote:
+        return None
+    body = data[start:end]
+    if body == record.docstring:
+        return start, end, quote, False
+    if not prefix and body == record.docstring.replace("\\", "\\\\"):
+        return start, end, quote, True
+    return None
+
+
+def _docstring_edit(data, lines, record, new_doc):
+    """
+    `Edit` replacing the docstring of ``record`` by ``new_doc``, if possible.
+    """
+    if ('"""' in new_doc) or ("'''" in new_doc):
+        # print(
+        #    "SKIPPING", filename, func.name, "triple quote not handled", new_doc
+        # )
+        return None
+    body = _docstring_body(data, lines, record)
+    if body is None:
+        return None
+    start, end, quote, escaped = body
+    if escaped:
+        new_doc = new_doc.replace("\\", "\\\\")
+    if new_doc.endswith(quote[0]):
+        return None
+    return Edit(start, end, new_doc)
+
+
+def docstring_edits(data, records, results):
+    """
+    Edits to apply to ``data`` for the reformatted docstrings ``results``.
+
+    Parameters
+    ----------
+    data : str
+        source of the file
+    records : list of DocstringRecord
+        docstrings found by ``_collect_docstrings`` in ``data``
+    results : list of (str or None, bool, tuple)
+        new docstring, whether it fails --check and its issues, for each
+        record, see `_reformat_docstring`
+
+    Returns
+    -------
+    list of Edit
+        sorted, non overlapping edits, see `apply_edits`
+    bool
+        Whether this file should fail under the --check flag
+    list of Finding
+        the docstrings failing --check, sorted
+    """
+    fail_check = False
+    edits = []
+    findings = []
+    lines = None
+    for record, (new_doc, _fail_check, issues) in zip(records, results):
+        if _fail_check:
+            fail_check = True
+        changed = bool(
+            new_doc is not None and new_doc.strip() and new_doc != record.docstring
+        )
+        if not (changed or _fail_check or issues):
+            continue
+        if lines is None:
+            lines = _LineOffsets(data)
+        edit = None
+        if changed:
+            edit = _docstring_edit(data, lines, record, new_doc)
+            if edit is not None:
+                edits.append(edit)
+            fail_check = True
+        if changed or not issues:
+            issues = (("reformat", "the docstring needs reformatting"), *issues)
+        if edit is not None:
+            start, end = edit.start, edit.end
+        else:
+            start = lines.offset(record.lineno, record.col_offset)
+            end = lines.offset(record.end_lineno, record.end_col_offset)
+        findings.append(Finding(record.qname, start, end, issues, edit))
+    edits.sort()
+    findings.sort(key=lambda finding: finding.start)
+    return edits, fail_check, findings
+
+
+def apply_edits(data, edits):
+    """
+    Apply sorted, non overlapping `Edit` to ``data`` in a single pass.
+    """
+    parts = []
+    last = 0
+    for start, end, text in edits:
+        parts.append(data[last:start])
+        parts.append(text)
+        last = end
+    parts.append(data[last:])
+    return "".join(parts)
+
+
+# a big file split by ``_submit_docstrings`` in main, with what was printed
+# and raised while splitting it.
+_SplitJob = namedtuple(
+    "_SplitJob", ["source", "key", "records", "futures", "out", "exc", "warned"]
+)
+
+
+def _submit_docstrings(
+    executor,
+    data,
+    filename,
+    compact,
+    unsafe,
+    fail,
+    config,
+    obj_p,
+    line_ranges=None,
+    *,
+    n_chunks,
+):
+    """
+    Split the docstrings of a file in (at most) ``n_chunks`` tasks on ``executor``.
+
+    Returns the records and the futures to pass to ``_collect_submitted``.
+    """
+    records = _collect_docstrings(data, filename, obj_p, line_ranges)
+    size = max(1, -(-len(records) // n_chunks))
+    futures = [
+        executor.submit(
+            _run_in_worker,
+            _reformat_docstrings_captured,
+            records[i : i + size],
+            filename,
+            compact,
+            unsafe,
+            fail,
+            config,
+        )
+        for i in range(0, len(records), size)
+    ]
+    return records, futures
+
+
+def _collect_submitted(data, records, futures):
+    """
+    Wait for the tasks of ``_submit_docstrings``, and return the edits to the
+    file and its findings, see `docstring_edits`.
+
+    Output of the workers is replayed in order, and the first exception is
+    re-raised, like in a serial run.
+    """
+    results = []
+    for future in futures:
+        (res, out, exc), state = future.result()
+        merge_worker_state(state)
+        sys.stdout.write(out)
+        if exc is not None:
+            for future in futures:
+                future.cancel()
+            raise exc
+        results.extend(res)
+    return docstring_edits(data, records, results)
+
+
 def _reformat_file(
-    data, filename, compact, unsafe, fail=False, config=None, obj_p=None
+    data,
+    filename,
+    compact,
+    unsafe,
+    fail=False,
+    config=None,
+    obj_p=None,
+    *,
+    executor=None,
+    n_chunks=None,
+    line_ranges=None,
 ):
     """
     Parameters
@@ -804,6 +1514,17 @@ def _reformat_file(
         <Multiline Description Here>
     filename : <Insert Type here>
         <Multiline Description Here>
+    obj_p : list of str
+        qualified names of objects to skip
+    executor : Executor, optional
+        if given, the docstrings of the file are split and reformatted on this
+        executor; the result is identical to the serial path.
+    n_chunks : int, optional
+        number of tasks to split the docstrings in when using ``executor``,
+        default to twice the number of cores.
+    line_ranges : list of (int, int), optional
+        only reformat the docstrings overlapping those line ranges (1-based,
+        inclusive), other docstrings are left untouched.
 
     Returns
     -------
@@ -813,112 +1534,74 @@ def _reformat_file(
         Whether this file should fail under the --check flag
 
     """
-    fail_check = False
+    edits, fail_check, _ = _file_edits(
+        data,
+        filename,
+        compact,
+        unsafe,
+        fail,
+        config,
+        obj_p,
+        executor=executor,
+        n_chunks=n_chunks,
+        line_ranges=line_ranges,
+    )
+    return apply_edits(data, edits), fail_check
+
+
+def _file_edits(
+    data,
+    filename,
+    compact,
+    unsafe,
+    fail,
+    config,
+    obj_p,
+    *,
+    executor=None,
+    n_chunks=None,
+    line_ranges=None,
+):
+    """
+    Like `_reformat_file`, but return the edits to apply to ``data`` instead of
+    the new file, and the findings, see `docstring_edits`.
+    """
     assert config is not None
 
-    tree = ast.parse(data, filename)
-    new = data
-
-    # funcs = [t for t in tree.body if isinstance(t, ast.FunctionDef)]
-    funcs = NodeVisitor({"skip": obj_p})
-    funcs.visit(tree)
-    funcs = funcs.items
-    for i, (func, meta, qname) in enumerate(funcs[:]):
-        # print(i, "==", func.name, "==")
-        try:
-            e0 = func.body[0]
-            if not isinstance(e0, ast.Expr):
-                continue
-            # e0.value is _likely_ a Constant node.
-            docstring = e0.value.s
-            func_name = func.name
-        except AttributeError:
-            continue
-        if not isinstance(docstring, str):
-            continue
-        start, nindent, _ = (
-            func.body[0].lineno,
-            func.body[0].col_offset,
-            func.body[0].end_lineno,
+    if executor is not None:
+        if n_chunks is None:
+            n_chunks = 2 * (os.cpu_count() or 1)
+        records, futures = _submit_docstrings(
+            executor,
+            data,
+            filename,
+            compact,
+            unsafe,
+            fail,
+            config,
+            obj_p,
+            line_ranges,
+            n_chunks=n_chunks,
         )
-        # if not docstring in data:
-        #    print(f"skip {file}: {func.name}, can't do replacement yet")
-        try:
-            new_doc, d_, jump_to_loc, _fail_check = compute_new_doc(
-                docstring,
-                filename,
-                level=nindent,
-                compact=compact,
-                meta=meta,
-                func_name=func_name,
-                config=config,
-            )
-            if _fail_check:
-                fail_check = True
-            if jump_to_loc:
-                print("mvim", f"+{start}", filename)
-                pass
-                # call editor with file and line number
-            elif not unsafe:
-                _, d2, _, _fail_check = compute_new_doc(
-                    docstring,
-                    filename,
-                    level=nindent,
-                    compact=compact,
-                    meta=meta,
-                    func_name=func_name,
-                    config=config,
-                )
-                if _fail_check:
-                    fail_check = True
-                if not d2._parsed_data == d_._parsed_data:
-                    secs1 = {
-                        k: v
-                        for k, v in d2._parsed_data.items()
-                        if v != d_._parsed_data[k]
-                    }
-                    secs2 = {
-                        k: v
-                        for k, v in d_._parsed_data.items()
-                        if v != d2._parsed_data[k]
-                    }
-                    raise ValueError(
-                        "Numpydoc parsing seem to differ after reformatting, this may be a reformatting bug. Rerun with `velin --unsafe "
-                        + str(filename)
-                        + ":"
-                        + qname
-                        + "`\n"
-                        + str(secs1)
-                        + "\n"
-                        + str(secs2),
-                    )
-        except Exception as e:
-            print(f"something went wrong with {filename}:{qname} :\n\n{docstring}")
-            if fail:
-                raise
-            else:
-                print(e)
-            continue
-        if not docstring.strip():
-            print("DOCSTRING IS EMPTY !!!", func.name)
-        # test(docstring, file)
-        if new_doc.strip() and new_doc != docstring:
-            # need_changes.append(str(filename) + f":{start}:{func.name}")
-            if ('"""' in new_doc) or ("'''" in new_doc):
-                # print(
-                #    "SKIPPING", filename, func.name, "triple quote not handled", new_doc
-                # )
-                pass
-            else:
-                # if docstring not in new:
-                #    print("ESCAPE issue:", docstring)
-                new = new.replace(docstring, new_doc)
-            fail_check = True
-    return new, fail_check
+        return _collect_submitted(data, records, futures)
+
+    records = _iter_docstrings(data, filename, obj_p, line_ranges)
+    if BLACK_REFORMAT:
+        # examples are formatted with one black call, before the docstrings.
+        records = list(records)
+        _batch_examples(records, compact, unsafe, config)
+    done, results = [], []
+    for record in records:
+        done.append(record)
+        results.append(
+            _reformat_docstring(record, filename, compact, unsafe, fail, config)
+        )
+    return docstring_edits(data, done, results)
 
 
 class SkipPattern:
     def __init__(self, value):
+        self.value = value
         if ":" in value:
             self.file_pattern, self.obj_pattern = value.split(":")
         else:
@@ -935,7 +1618,168 @@ class SkipPattern:
         return f"<SkipPattern {self.file}>"
 
 
-def main():
+class SkipPatterns:
+    """
+    Match paths against the ``ignore_patterns`` of setup.cfg.
+
+    The regexes are compiled once; all the patterns of a kind are also combined
+    in a single regex, so that a path matching none of them (the common case)
+    is rejected with one match.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        compiled = [(p, re.compile(p.file)) for p in patterns]
+        self._files = [(p, r) for p, r in compiled if p.obj_pattern is None]
+        self._objects = [(p, r) for p, r in compiled if p.obj_pattern is not None]
+        self._any_file = self._combine(self._files)
+        self._any_object = self._combine(self._objects)
+
+    @staticmethod
+    def _combine(compiled):
+        """
+        A regex matching if any of ``compiled`` does, None if they can't be combined.
+        """
+        if len(compiled) < 2 or any(r.groups for _, r in compiled):
+            # group numbers (and backreferences) would be shifted.
+            return None
+        try:
+            return re.compile("|".join(f"(?:{r.pattern})" for _, r in compiled))
+        except re.error:
+            return None
+
+    def excluding(self, path):
+        """
+        The first pattern excluding the whole file ``path``, None if there is none.
+        """
+        if self._any_file is not None and not self._any_file.match(path):
+            return None
+        for p, r in self._files:
+            if r.match(path):
+                return p
+        return None
+
+    def objects(self, path):
+        """
+        Qualified names of the objects to skip in ``path``.
+        """
+        if self._any_object is not None and not self._any_object.match(path):
+            return []
+        return [p.obj_pattern for p, r in self._objects if r.match(path)]
+
+
+def _format_file(
+    file, compact, unsafe, fail, config, obj_p, line_ranges=None, clean_key=None
+):
+    """
+    Read and reformat a single file.
+
+    Returns ``None`` if the file can't be read, otherwise the `Source` of the
+    file, the edits to it, whether the file should fail under --check, the
+    docstrings failing it (see `docstring_edits`) and the key of the file in
+    the cache. The file is not reformatted if its key is ``clean_key``, the key
+    of its content when it was last marked clean.
+    """
+    try:
+        source = read_file(file)
+    except Exception as e:
+        print(f"could not read {file}: {e}")
+        return None
+    data = source.text
+    key = file_key(data, obj_p)
+    if key == clean_key:
+        # modified since, but with the same content.
+        return source, [], False, [], key
+    with _watch_warnings():
+        edits, fail_check, findings = _file_edits(
+            data,
+            file,
+            compact,
+            unsafe,
+            fail,
+            config,
+            obj_p,
+            line_ranges=line_ranges,
+        )
+    return source, edits, fail_check, findings, key
+
+
+def _format_file_captured(task):
+    """
+    Worker side of ``--jobs``, run ``_format_file`` and capture its output.
+
+    Output and exceptions are sent back to the main process so that they can be
+    replayed in the same order as a serial run.
+    """
+    out = io.StringIO()
+    res, exc = None, None
+    with redirect_stdout(out):
+        try:
+            res = _format_file(*task)
+        except Exception as e:
+            exc = e
+    return res, out.getvalue(), exc
+
+
+def _run_in_worker(func, *args):
+    """
+    Run ``func`` in a worker process, and send back the stats and cache entries.
+    """
+    before = STATS.copy()
+    return func(*args), worker_state(before)
+
+
+def _init_worker(black_reformat, verbose, persist_memo):
+    global BLACK_REFORMAT, print
+    BLACK_REFORMAT = black_reformat
+    if persist_memo:
+        for memo in CACHES.values():
+            memo.load()
+    if verbose:
+        try:
+            from there import print
+        except ImportError:
+            pass
+
+
+def _jobs(value):
+    if value == "auto":
+        return os.cpu_count() or 1
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("--jobs must be a positive integer or 'auto'")
+    return jobs
+
+
+def _line_range(value):
+    try:
+        start, end = map(int, value.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid line range {value!r}, use START-END")
+    if not 1 <= start <= end:
+        raise argparse.ArgumentTypeError(f"invalid line range {value!r}")
+    return start, end
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["daemon"]:
+        from velin.daemon import serve_main
+
+        return serve_main(argv[1:])
+    if argv[:1] == ["lsp"]:
+        from velin.lsp import serve_main
+
+        return serve_main(argv[1:])
+    if "--use-daemon" in argv:
+        from velin.daemon import run_client
+
+        argv = [a for a in argv if a != "--use-daemon"]
+        code = run_client(argv)
+        if code is not None:
+            sys.exit(code)
+
     _config = ConfigParser()
     patterns = []
     if Path("setup.cfg").exists():
@@ -945,8 +1789,13 @@ def main():
             for x in _config.get("velin", "ignore_patterns", fallback="").split("\n")
             if x
         ]
+    patterns = SkipPatterns(patterns)
 
-    parser = argparse.ArgumentParser(description="reformat the docstrigns of some file")
+    parser = argparse.ArgumentParser(
+        description="reformat the docstrigns of some file",
+        epilog="Run `velin daemon` to keep vélin running in the background, "
+        "and pass --use-daemon to use it. `velin lsp` starts a language server.",
+    )
     parser.add_argument(
         "paths",
         metavar="path",
@@ -971,6 +1820,14 @@ def main():
         action="store_true",
         help="Print the list of files/lines number and exit with a non-0 exit status, Use it for CI.",
     )
+    parser.add_argument(
+        "--format",
+        choices=["text", "jsonl", "sarif"],
+        default="text",
+        help="Format of the --check report: text, JSON Lines or SARIF. With "
+        "jsonl and sarif, only the report goes to stdout, other messages go to "
+        "stderr and diffs are not printed.",
+    )
     parser.add_argument(
         "--no-diff",
         action="store_false",
@@ -1015,8 +1872,72 @@ def main():
         action="store_true",
         help="increase the verbosity of the output",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        dest="cache",
+        help="Do not read or write the cache of files known to be clean.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print statistics about the caches at the end of the run.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=1,
+        metavar="N",
+        help="Number of processes used to reformat files, 'auto' uses all the cores.",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="REF",
+        help="Only process the files added, modified or renamed since the git "
+        "revision REF (including uncommitted and untracked files).",
+    )
+    parser.add_argument(
+        "--line-ranges",
+        type=_line_range,
+        action="append",
+        metavar="START-END",
+        help="Only reformat the docstrings overlapping those lines (1-based, "
+        "inclusive), can be repeated.",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="Only process the files staged in git, and only the docstrings "
+        "overlapping the staged changes.",
+    )
+    parser.add_argument(
+        "--git-files",
+        action="store_true",
+        help="In git repositories, list the files of directories with git "
+        "ls-files instead of walking them.",
+    )
+    parser.add_argument(
+        "--no-exclude",
+        action="store_false",
+        dest="exclude",
+        help="Walk every directory, including the ones ignored by git, virtual "
+        "environments and build directories.",
+    )
+    parser.add_argument(
+        "--use-daemon",
+        action="store_true",
+        help="Run in the `velin daemon` if one is running, locally otherwise.",
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.staged and (args.since is not None or args.line_ranges):
+        parser.error("--staged can't be used with --since or --line-ranges")
+    if args.line_ranges and (len(args.paths) != 1 or Path(args.paths[0]).is_dir()):
+        # the same lines of different files are unrelated.
+        parser.error("--line-ranges can only be used with a single file")
+    if args.format != "text" and not args.check:
+        parser.error(f"--format {args.format} needs --check")
 
     config = Config(
         {
@@ -1040,77 +1961,262 @@ def main():
         except ImportError:
             pass
 
-    to_format = []
+    changed = None
+    staged = None
+    if args.since is not None:
+        from velin.git import GitError, changed_files
 
-    for f in args.paths:
-        p = Path(f)
-        if p.is_dir():
-            for sf in p.glob("**/*.py"):
-                to_format.append(sf)
-        else:
-            to_format.append(p)
+        try:
+            changed = changed_files(args.since)
+        except GitError as e:
+            sys.exit(f"velin: --since {args.since}: {e}")
+    elif args.staged:
+        from velin.git import GitError, staged_line_ranges
 
-    def to_skip(file, patterns):
-        for p in patterns:
-            if re.match(p.file, file):
-                if p.obj_pattern is None:
-                    return True
-                else:
+        try:
+            staged = staged_line_ranges()
+        except GitError as e:
+            sys.exit(f"velin: --staged: {e}")
+        changed = set(staged)
+
+    def line_ranges(file):
+        if staged is not None:
+            return staged[file.resolve()]
+        return args.line_ranges
+
+    def to_format():
+        for f in args.paths:
+            p = Path(f)
+            if changed is not None:
+                # only the changed files among the ones a run would process.
+                root = p.resolve()
+                if p.is_dir():
+                    if not any(root in c.parents for c in changed):
+                        continue
+                    for c in python_files(
+                        p, exclude=args.exclude, use_git=args.git_files
+                    ):
+                        if root / c.relative_to(p) in changed:
+                            yield c
+                elif root in changed:
+                    yield p
+            elif p.is_dir():
+                yield from python_files(p, exclude=args.exclude, use_git=args.git_files)
+            else:
+                yield p
+
+    cache = None
+    if args.cache:
+        for memo in CACHES.values():
+            memo.load()
+        cache = Cache.read(
+            {
+                "config": config._conf,
+                "compact": args.compact,
+                "unsafe": args.unsafe,
+                "black": BLACK_REFORMAT,
+            }
+        )
+
+    ignored = {}
+
+    def plan():
+        """
+        ``(file, obj_p, clean_key)`` as the files are found, ``obj_p`` is None
+        for ignored files. Files known to be clean and unmodified are left out
+        without being read, ``clean_key`` is the cache key of the content of
+        modified files when they were last clean, see `Cache.lookup`.
+        """
+        for file in to_format():
+            if (pattern := patterns.excluding(str(file))) is not None:
+                ignored[file] = pattern
+                yield file, None, None
+                continue
+            obj_p = patterns.objects(str(file))
+            clean_key = None
+            if cache is not None:
+                clean_key, unchanged = cache.lookup(file, obj_p)
+                if unchanged and cache.is_clean(clean_key):
                     continue
-        return False
+            yield file, obj_p, clean_key
 
-    need_changes = []
-    for file in to_format:
-        if to_skip(str(file), patterns):
-            print("ignoring", file)
-            continue
+    executor = None
 
+    def submit(task):
+        """
+        Submit a task to the executor, big files are split by docstrings.
+        """
+        file = task[0]
         try:
-            with open(file) as f:
-                data = f.read()
-        except Exception as e:
-            # continue
-            continue
-            raise RuntimeError(f"Fail reading {file}") from e
-
-        obj_p = [p.obj_pattern for p in patterns if re.match(p.file, str(file))]
-        new, _fail_check = _reformat_file(
-            data,
-            file,
-            args.compact,
-            args.unsafe,
-            fail=args.fail,
-            config=config,
-            obj_p=obj_p,
-        )
-        # test(docstring, file)
-        if new != data:
-            need_changes.append(str(file))
-
-            dold = data.splitlines()
-            dnew = new.splitlines()
-            diffs = list(
-                difflib.unified_diff(
-                    dold, dnew, n=args.context, fromfile=str(file), tofile=str(file)
-                ),
-            )
+            if file.stat().st_size < SPLIT_FILE_SIZE:
+                return executor.submit(_run_in_worker, _format_file_captured, task)
+            source = read_file(file)
+        except Exception:
+            return executor.submit(_run_in_worker, _format_file_captured, task)
+        key = file_key(source.text, task[5])
+        out = io.StringIO()
+        records, futures, exc = [], [], None
+        with redirect_stdout(out), _watch_warnings() as shown:
+            try:
+                if key != task[-1]:
+                    records, futures = _submit_docstrings(
+                        executor, source.text, file, *task[1:-1], n_chunks=2 * args.jobs
+                    )
+            except Exception as e:
+                exc = e
+        return _SplitJob(source, key, records, futures, out, exc, bool(shown))
 
-            if args.print_diff and not args.write:
-                code = "\n".join(diffs)
+    def schedule():
+        """
+        ``[file, obj_p, job]`` for each planned file, job is None for ignored
+        files.
 
-                if args.do_highlight:
-                    from pygments import highlight
-                    from pygments.formatters import TerminalFormatter
-                    from pygments.lexers import DiffLexer
+        With --jobs, tasks are submitted as the files are found, once there are
+        at least two of them; otherwise the job is the task, run when its result
+        is needed.
+        """
+        nonlocal executor
+        first = None
+        for file, obj_p, clean_key in plan():
+            if obj_p is None:
+                yield [file, None, None]
+                continue
+            task = (
+                file,
+                args.compact,
+                args.unsafe,
+                args.fail,
+                config,
+                obj_p,
+                line_ranges(file),
+                clean_key,
+            )
+            entry = [file, obj_p, task]
+            if args.jobs > 1:
+                if executor is None and first is None:
+                    first = entry
+                else:
+                    if executor is None:
+                        from concurrent.futures import ProcessPoolExecutor
 
-                    code = highlight(code, DiffLexer(), TerminalFormatter())
+                        executor = ProcessPoolExecutor(
+                            max_workers=args.jobs,
+                            initializer=_init_worker,
+                            initargs=(BLACK_REFORMAT, args.verbose, args.cache),
+                        )
+                        first[2] = submit(first[2])
+                    entry[2] = submit(task)
+            yield entry
 
-                print(code)
-            if args.write:
-                with open(file, "w") as f:
-                    f.write(new)
-        elif _fail_check:
-            need_changes.append(str(file))
+    def _result(entry):
+        """
+        Result of a job, with its captured output and exception.
+        """
+        job, entry[2] = entry[2], None
+        if not isinstance(job, tuple):
+            res, state = job.result()
+            merge_worker_state(state)
+            return res
+        if not isinstance(job, _SplitJob):
+            return _format_file_captured(job)
+        source, key, records, futures, out, exc, warned = job
+        if warned:
+            STATS["warned"] += 1
+        res = None
+        if exc is None:
+            with redirect_stdout(out):
+                try:
+                    res = _collect_submitted(source.text, records, futures)
+                    res = (source, *res, key)
+                except Exception as e:
+                    exc = e
+        return res, out.getvalue(), exc
+
+    entries = []
+    need_changes = []
+    writer = SourceWriter() if args.write else None
+    printer = DiffPrinter(args.do_highlight)
+    report = None
+    stdout = sys.stdout
+    if args.format != "text":
+        from velin.report import REPORTS
+
+        # the report alone goes to stdout.
+        report = REPORTS[args.format](stdout)
+        sys.stdout = sys.stderr
+    failed = 0
+    try:
+        scheduled = schedule()
+        if args.jobs > 1:
+            # submit everything before waiting on the first result.
+            for entry in scheduled:
+                entries.append(entry)
+            scheduled = entries
+        for entry in scheduled:
+            file, obj_p, job = entry
+            if obj_p is None:
+                if args.verbose:
+                    print("ignoring", file, f"(ignore_patterns: {ignored[file].value})")
+                else:
+                    print("ignoring", file)
+                continue
+            warned = STATS["warned"]
+            res, out, exc = _result(entry)
+            sys.stdout.write(out)
+            if exc is not None:
+                raise exc
+            if res is None:
+                continue
+            source, edits, _fail_check, findings, key = res
+            data = source.text
+            # test(docstring, file)
+            if edits or _fail_check:
+                if report is None:
+                    need_changes.append(str(file))
+                else:
+                    # reported as they come, rather than kept until the end.
+                    report.add(str(file), data, findings)
+                    failed += 1
+            if edits:
+                if args.print_diff and not args.write and report is None:
+                    printer.print(unified_diff(data, edits, str(file), args.context))
+                if writer is not None:
+                    writer.write(file, apply_edits(data, edits), source)
+            elif (
+                not _fail_check
+                and cache is not None
+                and not out
+                and STATS["warned"] == warned
+                and line_ranges(file) is None
+            ):
+                cache.mark_clean(key, file, obj_p, (source.size, source.mtime_ns))
+    finally:
+        if executor is not None:
+            # like shutdown(cancel_futures=True), which needs Python 3.9
+            for _, _, job in entries:
+                if isinstance(job, _SplitJob):
+                    for future in job.futures or ():
+                        future.cancel()
+                elif job is not None and not isinstance(job, tuple):
+                    job.cancel()
+            executor.shutdown()
+        if cache is not None:
+            cache.write()
+            for memo in CACHES.values():
+                memo.dump()
+        if args.stats:
+            for name in CACHES:
+                print(hit_rate(name), file=sys.stderr)
+            print(
+                f"prefilter: {STATS['parse_skipped']} files skipped without parsing",
+                file=sys.stderr,
+            )
+        if writer is not None:
+            # rename the files written since the last batch.
+            writer.flush()
+        if report is not None:
+            sys.stdout = stdout
+            report.close()
 
     if args.check:
         if len(need_changes) != 0:
@@ -1118,4 +2224,4 @@ def main():
                 "Some files/functions need updates:\n - " + "\n - ".join(need_changes)
             )
         else:
-            sys.exit(0)
+            sys.exit(1 if failed else 0)
@@ -0,0 +1,172 @@
+"""
+Machine readable reports of ``velin --check``, see ``--format``.
+
+Each docstring failing the check is written as soon as the result of its file
+is known, and nothing is kept once written, so that memory does not grow with
+the number of files checked. Lines and columns are 1-based, columns count
+characters, and the end column is the one following the span.
+"""
+
+import json
+from bisect import bisect_right
+from pathlib import Path
+from urllib.parse import quote
+
+import velin
+from velin.ref import _LineOffsets
+
+RULES = {
+    "reformat": "The docstring is not formatted as vélin would format it.",
+    "missing-parameter": "A parameter of the function is not documented.",
+    "extra-parameter": "A documented parameter is not a parameter of the function.",
+    "renamed-parameter": "A documented parameter does not have the name of the "
+    "parameter of the function.",
+}
+
+
+def _span(lines, start, end):
+    """
+    ``(start_line, start_column, end_line, end_column)`` of the offsets
+    ``start`` and ``end`` of the source indexed by ``lines``.
+    """
+    res = []
+    for offset in (start, end):
+        line = bisect_right(lines.starts, offset) - 1
+        res += [line + 1, offset - lines.starts[line] + 1]
+    return tuple(res)
+
+
+class JsonLinesReport:
+    """
+    One JSON object per line for each docstring failing the check.
+
+    With the ``path`` of the file, the ``qname`` of the function, the span of
+    the docstring, its ``issues`` (``kind`` and ``message``) and the
+    ``replacement`` text of the span, null if vélin can't fix it.
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def add(self, path, data, findings):
+        lines = _LineOffsets(data)
+        for finding in findings:
+            start_line, start_column, end_line, end_column = _span(
+                lines, finding.start, finding.end
+            )
+            record = {
+                "path": path,
+                "qname": finding.qname,
+                "start_line": start_line,
+                "start_column": start_column,
+                "end_line": end_line,
+                "end_column": end_column,
+                "issues": [
+                    {"kind": kind, "message": message}
+                    for kind, message in finding.issues
+                ],
+                "replacement": finding.edit.text if finding.edit else None,
+            }
+            self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
+    def close(self):
+        self.out.flush()
+
+
+class SarifReport:
+    """
+    SARIF 2.1.0 log, with a result for each issue of the docstrings failing
+    the check.
+
+    The replacement text is given as the fix of the "reformat" results. The
+    results are written as they come, the log is completed by `close`.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self._separator = ""
+        log = {
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+            "runs": [
+                {
+                    "tool": {
+                        "driver": {
+                            "name": "velin",
+                            "version": velin.__version__,
+                            "informationUri": "https://github.com/Carreau/velin",
+                            "rules": [
+                                {"id": kind, "shortDescription": {"text": text}}
+                                for kind, text in RULES.items()
+                            ],
+                        }
+                    },
+                    "columnKind": "unicodeCodePoints",
+                    "results": [],
+                }
+            ],
+        }
+        self._head, self._tail = json.dumps(log).split('"results": []')
+        self.out.write(self._head + '"results": [')
+
+    def add(self, path, data, findings):
+        lines = _LineOffsets(data)
+        path = Path(path)
+        uri = path.as_uri() if path.is_absolute() else quote(path.as_posix())
+        for finding in findings:
+            start_line, start_column, end_line, end_column = _span(
+                lines, finding.start, finding.end
+            )
+            region = {
+                "startLine": start_line,
+                "startColumn": start_column,
+                "endLine": end_line,
+                "endColumn": end_column,
+            }
+            location = {
+                "physicalLocation": {
+                    "artifactLocation": {"uri": uri},
+                    "region": region,
+                },
+                "logicalLocations": [
+                    {"fullyQualifiedName": finding.qname, "kind": "function"}
+                ],
+            }
+            for kind, message in finding.issues:
+                result = {
+                    "ruleId": kind,
+                    "level": "error",
+                    "message": {"text": f"{finding.qname}: {message}"},
+                    "locations": [location],
+                }
+                if kind == "reformat" and finding.edit is not None:
+                    result["fixes"] = [
+                        {
+                            "description": {"text": "Reformat the docstring"},
+                            "artifactChanges": [
+                                {
+                                    "artifactLocation": {"uri": uri},
+                                    "replacements": [
+                                        {
+                                            "deletedRegion": region,
+                                            "insertedContent": {
+                                                "text": finding.edit.text
+                                            },
+                                        }
+                                    ],
+                                }
+                            ],
+                        }
+                    ]
+                self.out.write(self._separator + json.dumps(result))
+                self._separator = ", "
+        self.out.flush()
+
+    def close(self):
+        self.out.write("]" + self._tail + "\n")
+        self.out.flush()
+
+
+# reporters by --format.
+REPORTS = {"jsonl": JsonLinesReport, "sarif": SarifReport}
@@ -0,0 +1,218 @@
+"""
+Find the Python files of the directories given to vélin.
+
+Directories are walked in sorted order, without descending into the ones that
+are excluded: version control and tool directories, virtual environments,
+build outputs, and anything ignored by ``.gitignore`` files.
+"""
+
+import os
+import re
+from pathlib import Path
+
+# like black's default --exclude
+DEFAULT_EXCLUDES = frozenset(
+    {
+        ".bzr",
+        ".direnv",
+        ".eggs",
+        ".git",
+        ".hg",
+        ".mypy_cache",
+        ".nox",
+        ".pytest_cache",
+        ".svn",
+        ".tox",
+        ".venv",
+        "__pycache__",
+        "__pypackages__",
+        "_build",
+        "buck-out",
+        "build",
+        "dist",
+        "node_modules",
+        "venv",
+    }
+)
+
+
+def _translate(pattern):
+    """
+    Regex for a gitignore glob, ``*`` and ``?`` do not match ``/``.
+    """
+    parts = pattern.split("/")
+    res = []
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == "**":
+            res.append(".*" if last else "(?:.*/)?")
+            continue
+        j = 0
+        while j < len(part):
+            c = part[j]
+            j += 1
+            if c == "*":
+                res.append("[^/]*")
+            elif c == "?":
+                res.append("[^/]")
+            elif c == "\\" and j < len(part):
+                res.append(re.escape(part[j]))
+                j += 1
+            elif c == "[" and (end := part.find("]", j + 1)) != -1:
+                chars = part[j:end]
+                if chars[:1] == "!":
+                    chars = "^" + chars[1:]
+                res.append("[" + chars.replace("\\", "\\\\") + "]")
+                j = end + 1
+            else:
+                res.append(re.escape(c))
+        if not last:
+            res.append("/")
+    return "".join(res)
+
+
+class GitIgnore:
+    """
+    Rules of a ``.gitignore`` file.
+
+    ``base`` is the directory of the file, relative to the root of the
+    repository, with a trailing ``/`` unless it is the root.
+    """
+
+    def __init__(self, base, lines):
+        self.base = base
+        self.rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                line = line.lstrip("/")
+                regex = _translate(line)
+            else:
+                regex = "(?:.*/)?" + _translate(line)
+            self.rules.append((re.compile(regex + r"\Z"), negate, dir_only))
+
+    @classmethod
+    def read(cls, path, base):
+        try:
+            with open(path) as f:
+                return cls(base, f.readlines())
+        except OSError:
+            return None
+
+    def match(self, path, is_dir):
+        """
+        True if ``path`` (relative to the repository) is ignored, False if it is
+        re-included, None if no rule applies.
+        """
+        if not path.startswith(self.base):
+            return None
+        path = path[len(self.base) :]
+        for regex, negate, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                return not negate
+        return None
+
+
+def _ignored(ignores, path, is_dir):
+    # the closest .gitignore has precedence.
+    for ignore in reversed(ignores):
+        res = ignore.match(path, is_dir)
+        if res is not None:
+            return res
+    return False
+
+
+def _repository(root):
+    """
+    Root of the repository containing ``root`` and the ignore rules that apply
+    above ``root`` in it, ``root`` itself and no rules outside a repository.
+    """
+    root = root.resolve()
+    for top in [root, *root.parents]:
+        if (top / ".git").exists():
+            break
+    else:
+        return root, []
+    ignores = []
+    exclude = GitIgnore.read(top / ".git" / "info" / "exclude", "")
+    if exclude is not None:
+        ignores.append(exclude)
+    for parent in reversed([root, *root.parents]):
+        if parent == root or top not in [parent, *parent.parents]:
+            continue
+        rel = parent.relative_to(top).as_posix()
+        base = "" if rel == "." else rel + "/"
+        if (ignore := GitIgnore.read(parent / ".gitignore", base)) is not None:
+            ignores.append(ignore)
+    return top, ignores
+
+
+def python_files(root, exclude=True, use_git=False):
+    """
+    Generate the Python files under the directory ``root``, as they are found.
+
+    With ``exclude``, directories in ``DEFAULT_EXCLUDES``, virtual environments,
+    and paths ignored by git are skipped without being walked. With
+    ``use_git``, the files are listed by ``git ls-files`` instead, if ``root``
+    is in a git repository.
+    """
+    root = Path(root)
+    if use_git:
+        from velin.git import GitError, ls_python_files
+
+        try:
+            files = ls_python_files(root)
+        except GitError:
+            pass
+        else:
+            yield from files
+            return
+    if not exclude:
+        yield from _walk(root, None, [], False)
+        return
+    top, ignores = _repository(root)
+    rel = root.resolve().relative_to(top).as_posix()
+    yield from _walk(root, "" if rel == "." else rel + "/", ignores, True)
+
+
+def _walk(directory, rel, ignores, exclude):
+    if exclude:
+        ignore = GitIgnore.read(directory / ".gitignore", rel)
+        if ignore is not None:
+            ignores = [*ignores, ignore]
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return
+    dirs = []
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if exclude:
+            if is_dir and (
+                entry.name in DEFAULT_EXCLUDES
+                or os.path.exists(os.path.join(entry.path, "pyvenv.cfg"))
+            ):
+                continue
+            if _ignored(ignores, rel + entry.name, is_dir):
+                continue
+        if is_dir:
+            dirs.append(entry.name)
+        elif entry.name.endswith(".py") and entry.is_file():
+            yield directory / entry.name
+    for name in dirs:
+        sub = None if rel is None else rel + name + "/"
+        yield from _walk(directory / name, sub, ignores, exclude)